@@ -0,0 +1,153 @@
+"""
+Cache of parsed NZBs.
+
+Opening a large NZB means parsing the XML, grabbing the first and last segment
+of every file to work out the proper filenames and volume order, and building
+the ``RarSet``.  None of that changes between runs, so once it's done the
+result is stored here, keyed by the SHA-1 of the NZB content:
+
+    * the segment table, as the raw ``array`` columns
+    * every file's subject, resolved filename and segment range
+    * every rarset in the NZB, and the rarchives of the one streamed, in
+      volume order; or the media files, for posts that aren't archived
+    * where the extracted file's data sits in every rarchive, for seeking
+    * the files whose headers are in the first segment of every rarchive,
+      so that segments of unwanted files can be left out
+
+Entries are stored in a small binary format: a fixed header followed by
+length-prefixed sections.  Because the key is the content hash, the NZB still
+has to be read to find its entry; a second, tiny file per source records that
+the source has been cached before so that the NZB is only buffered up front
+when there's a good chance of a hit.
+"""
+
+import hashlib
+import logging
+import marshal
+import os
+import struct
+
+from array import array
+from nzbstream import nzb
+
+log = logging.getLogger('nzbstream.cache')
+
+DEFAULT_CACHE_DIR   = '~/.cache/nzbstream'
+CACHE_MAGIC         = 'NZBC'
+CACHE_VERSION       = 7
+CACHE_HEADER        = struct.Struct('<4sHBd')   # magic, version, itemsize, startup time
+SECTION_HEADER      = struct.Struct('<I')       # length of the section
+
+class CacheEntry(object):
+    """
+    Everything needed to start streaming an NZB without parsing it again.
+    """
+    def __init__(self, table, files, rarchives, layout=None, startup=0, members=None,
+                 rarsets=None, selected=0, plain=False):
+        self.table      = table     # nzb.SegmentTable
+        self.files      = files     # List of nzb.NZBFile
+        self.rarchives  = rarchives # Indices in files of the rarchives, in order
+        self.layout     = layout    # See Manager.layout
+        self.startup    = startup   # Seconds it took to initialize without the cache
+        self.members    = members   # See Manager.members
+        self.rarsets    = rarsets   # (name, indices in files, members) of every rarset
+        self.selected   = selected  # Index in rarsets of the rarset of rarchives
+        self.plain      = plain     # True if rarsets are media files, see plain.find_sets
+
+class NZBCache(object):
+    def __init__(self, path=DEFAULT_CACHE_DIR):
+        self.path = os.path.expanduser(path)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, "%s.nzbc" % key)
+
+    def _source_path(self, source):
+        return os.path.join(self.path, "%s.src" % hashlib.sha1(source).hexdigest())
+
+    def known(self, source):
+        """
+        Returns True if an NZB from ``source`` has been cached before.
+        """
+        return os.path.exists(self._source_path(source))
+
+    def load(self, key):
+        """
+        Returns the ``CacheEntry`` stored for ``key`` or ``None``.
+        """
+        path = self._entry_path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            return self._unpack(data)
+        except Exception, e:
+            log.error("Could not read cache entry %s: %s" % (path, e))
+            return None
+
+    def store(self, key, source, entry):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0700)
+
+        path = self._entry_path(key)
+        tmp  = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(self._pack(entry))
+        os.rename(tmp, path)
+
+        with open(self._source_path(source), 'wb') as f:
+            f.write(key)
+        log.debug("Stored cache entry %s" % path)
+
+    def _pack(self, entry):
+        table = entry.table
+        files = [(f.subject, f.filename, f.poster, f.date, f.groups, f.start, f.count)
+                 for f in entry.files]
+        meta  = marshal.dumps((files, entry.rarchives, entry.layout, entry.members,
+                               entry.rarsets, entry.selected, entry.plain))
+
+        sections = [meta, table.sizes.tostring(), table.numbers.tostring(),
+                    table.files.tostring(), table._ids.tostring(),
+                    table._offsets.tostring()]
+
+        data = [CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, table.sizes.itemsize, entry.startup)]
+        for section in sections:
+            data.append(SECTION_HEADER.pack(len(section)))
+            data.append(section)
+        return ''.join(data)
+
+    def _unpack(self, data):
+        magic, version, itemsize, startup = CACHE_HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION or itemsize != array('I').itemsize:
+            log.debug("Ignoring incompatible cache entry")
+            return None
+
+        pos      = CACHE_HEADER.size
+        sections = []
+        while pos < len(data):
+            length = SECTION_HEADER.unpack_from(data, pos)[0]
+            pos   += SECTION_HEADER.size
+            sections.append(data[pos:pos+length])
+            pos   += length
+
+        meta, sizes, numbers, files, ids, offsets = sections
+
+        table = nzb.SegmentTable()
+        table.sizes.fromstring(sizes)
+        table.numbers.fromstring(numbers)
+        table.files.fromstring(files)
+        table._ids.fromstring(ids)
+        table._offsets = array('I')
+        table._offsets.fromstring(offsets)
+
+        files, rarchives, layout, members, rarsets, selected, plain = marshal.loads(meta)
+        nzb_files = []
+        for subject, filename, poster, date, groups, start, count in files:
+            f = nzb.NZBFile(table, start, count, poster, date, subject)
+            f.filename = filename
+            f.groups   = groups
+            nzb_files.append(f)
+
+        return CacheEntry(table, nzb_files, rarchives, layout, startup, members, rarsets, selected,
+                          plain)
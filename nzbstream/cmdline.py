@@ -1,12 +1,15 @@
 import getopt
+import getpass
 import logging
 import nntplib
 import pynzb
+import shlex
 import signal
 import sys
+import time
 
 from nzbverify import conf
-from nzbstream import __version__, rar, nntp, manager
+from nzbstream import __version__, rar, nntp, manager, httpserver, pipe, scheduler, writer, extract
 
 __prog__ = "nzbstream"
 
@@ -24,6 +27,20 @@ Options:
     -e              : Use SSL/TLS encryption
     -q              : Skip verification stage
     -b<bitrate>     : Maximum bitrate of file (in Bps)
+    -f              : Fast start; fetch the likely first volume during discovery
+    -C              : Don't use the cache of parsed NZBs
+    -S<port>        : Serve the extracted file over HTTP on this local port
+    -o<path>        : Stream the extracted file into a pipe instead of onto disk ('-' for stdout)
+    -r<seconds>     : Seconds of media to fetch ahead of the player (default: %d)
+    -t<seconds>     : Seconds of media to keep buffered before throttling (default: %d)
+    --fsync=<policy>: When to fsync the extracted file: never, close, batch or every <seconds>
+    -m              : Memory map the extracted file, for the HTTP server and other local readers
+    --extract=<cmd> : Command compressed rars are piped through (default: %s)
+    --rar-password  : Prompt for the password of encrypted rars
+    --include=<pat> : Only extract rar members matching this pattern (repeatable)
+    --exclude=<pat> : Don't extract rar members matching this pattern (repeatable)
+    -l              : List the rarsets (or unarchived media files) in the NZB and exit
+    --rarset=<set>  : Rarset to stream, by number in the listing or name pattern (default: the first)
     -h              : Show help text and exit
 """
 
@@ -33,9 +50,14 @@ DEFAULT_NUM_CONNECTIONS = 1
 log = logging.getLogger('nzstream')
 
 def print_usage():
-    print __usage__ % __prog__
+    print __usage__ % (__prog__, scheduler.DEFAULT_READ_AHEAD, scheduler.DEFAULT_BUFFER_TARGET,
+                       ' '.join(extract.DEFAULT_COMMAND))
 
-def main(file_name, nntp_kwargs, max_bitrate=None, do_verify=True):
+def main(file_name, nntp_kwargs, max_bitrate=None, do_verify=True, fast_start=False, use_cache=True,
+         serve_port=None, output=None, read_ahead=scheduler.DEFAULT_READ_AHEAD,
+         buffer_target=scheduler.DEFAULT_BUFFER_TARGET, fsync=writer.DEFAULT_FSYNC, use_mmap=False,
+         extract_command=extract.DEFAULT_COMMAND, rar_password=None, include=None, exclude=None,
+         list_rarsets=False, select=None):
     nzb_file    = None
     nzb         = None
     rs          = None
@@ -55,7 +77,22 @@ def main(file_name, nntp_kwargs, max_bitrate=None, do_verify=True):
     # TODO: Listen to other signals
     signal.signal(signal.SIGINT, signal_handler)
 
-    mgr = manager.Manager(file_name, nntp_kwargs, max_bitrate, do_verify)
+    mgr = manager.Manager(file_name, nntp_kwargs, max_bitrate=max_bitrate, do_verify=do_verify,
+                          fast_start=fast_start, use_cache=use_cache, output=output,
+                          read_ahead=read_ahead, buffer_target=buffer_target, fsync=fsync,
+                          use_mmap=use_mmap, extract_command=extract_command,
+                          rar_password=rar_password, include=include, exclude=exclude,
+                          select=select)
+
+    if list_rarsets:
+        if not mgr.initialize(list_only=True):
+            print "[Error] Manager failed to initialize"
+            return
+        for number, name, volumes, size, members in mgr.list_rarsets():
+            print "%3d. %s (%d volumes, %.1f MB)" % (number, name, volumes, size/1048576.0)
+            for member in members:
+                print "       %s" % member
+        return
 
     if not mgr.initialize():
         print "[Error] Manager failed to initialize"
@@ -65,8 +102,22 @@ def main(file_name, nntp_kwargs, max_bitrate=None, do_verify=True):
         print "[Error] Verification failed"
         return
 
+    http = None
+    if serve_port:
+        http = httpserver.StreamServer(mgr, port=serve_port)
+        http.start()
+        print "Serving %s" % http.url
+
     mgr.stream()
 
+    if output:
+        output.close()
+
+    if http:
+        # Keep serving until we're interrupted
+        while True:
+            time.sleep(1)
+
     return
 
     print "Parsing NZB: %s" % file_name
@@ -125,12 +176,24 @@ def main(file_name, nntp_kwargs, max_bitrate=None, do_verify=True):
 
 
 def run():
-    print "%s version %s" % (__prog__, __version__)
-        
     num_connections = DEFAULT_NUM_CONNECTIONS
     config          = None
     max_bitrate     = None
     do_verify       = True
+    fast_start      = False
+    use_cache       = True
+    serve_port      = None
+    output          = None
+    read_ahead      = scheduler.DEFAULT_READ_AHEAD
+    buffer_target   = scheduler.DEFAULT_BUFFER_TARGET
+    fsync           = writer.DEFAULT_FSYNC
+    use_mmap        = False
+    extract_command = extract.DEFAULT_COMMAND
+    rar_password    = None
+    include         = []
+    exclude         = []
+    list_rarsets    = False
+    select          = None
     nntp_kwargs     = {
         'host':     None,
         'port':     nntplib.NNTP_PORT,
@@ -142,7 +205,7 @@ def run():
     }
     
     # Parse command line options
-    opts, args = getopt.getopt(sys.argv[1:], 's:u:P:n:c:b:qeph', [
+    opts, args = getopt.getopt(sys.argv[1:], 's:u:P:n:c:b:S:o:r:t:qefCmplh', [
         "server=",
         "username=", 
         "port=",
@@ -152,6 +215,20 @@ def run():
         "password",
         "verify",
         "bitrate=",
+        "fast-start",
+        "no-cache",
+        "serve=",
+        "output=",
+        "read-ahead=",
+        "buffer=",
+        "fsync=",
+        "mmap",
+        "extract=",
+        "rar-password",
+        "include=",
+        "exclude=",
+        "list",
+        "rarset=",
         "help"])
     for o, a in opts:
         if o in ("-h", "--help"):
@@ -187,7 +264,56 @@ def run():
                 sys.exit(0)
         elif o in ("-q", "--verify"):
             do_verify = False
-    
+        elif o in ("-f", "--fast-start"):
+            fast_start = True
+        elif o in ("-C", "--no-cache"):
+            use_cache = False
+        elif o in ("-S", "--serve"):
+            try:
+                serve_port = int(a)
+            except:
+                print "Error: invalid port '%s'" % a
+                sys.exit(0)
+        elif o in ("-o", "--output"):
+            output = a
+        elif o in ("-r", "--read-ahead"):
+            try:
+                read_ahead = float(a)
+            except:
+                print "Error: invalid read-ahead '%s'" % a
+                sys.exit(0)
+        elif o in ("-t", "--buffer"):
+            try:
+                buffer_target = float(a)
+                if buffer_target <= 0:
+                    raise ValueError
+            except:
+                print "Error: invalid buffer '%s'" % a
+                sys.exit(0)
+        elif o in ("-m", "--mmap"):
+            use_mmap = True
+        elif o == "--extract":
+            extract_command = shlex.split(a)
+            if not extract_command:
+                print "Error: invalid extract command '%s'" % a
+                sys.exit(0)
+        elif o == "--rar-password":
+            rar_password = getpass.getpass("Rar password: ").decode(sys.stdin.encoding or 'utf-8')
+        elif o == "--include":
+            include.append(a)
+        elif o == "--exclude":
+            exclude.append(a)
+        elif o in ("-l", "--list"):
+            list_rarsets = True
+        elif o == "--rarset":
+            select = a
+        elif o == "--fsync":
+            try:
+                fsync = writer.parse_fsync(a)
+            except ValueError:
+                print "Error: invalid fsync policy '%s'" % a
+                sys.exit(0)
+
     # Get the NZB
     if len(args) < 1:
         print_usage()
@@ -216,4 +342,17 @@ def run():
             nntp_kwargs['user'] = credentials[0]
             nntp_kwargs['password'] = credentials[2]
 
-    main(nzb, nntp_kwargs, max_bitrate, do_verify)
+    # Only opened once the arguments check out, since that starts the pipe
+    if output:
+        output = pipe.open_pipe(output)
+        if output.target is sys.stdout:
+            # Everything we print goes to stderr instead
+            sys.stdout = sys.stderr
+
+    print "%s version %s" % (__prog__, __version__)
+
+    main(nzb, nntp_kwargs, max_bitrate=max_bitrate, do_verify=do_verify, fast_start=fast_start,
+         use_cache=use_cache, serve_port=serve_port, output=output, read_ahead=read_ahead,
+         buffer_target=buffer_target, fsync=fsync, use_mmap=use_mmap,
+         extract_command=extract_command, rar_password=rar_password, include=include,
+         exclude=exclude, list_rarsets=list_rarsets, select=select)
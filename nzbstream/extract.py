@@ -0,0 +1,119 @@
+"""
+Streaming extraction of compressed rar members.
+
+Stored members are copied out of the segments as they arrive, but a
+compressed member has to go through a decompressor.  ``Extractor`` runs one
+as a subprocess: the volumes are written to its stdin in order, straight from
+the downloaded segments, and a background thread reads the extracted bytes
+off its stdout into the extracted file or pipe.
+
+``unrar`` itself can't be used for this.  It seeks around in the archive and
+won't read one from stdin; ``rarspec.PipeReader`` has it read the volumes from
+disk.  libarchive's ``bsdtar`` reads RAR archives sequentially, with the
+volumes simply concatenated, so that's the default command.  Any command that
+reads the archive on stdin and writes the member to stdout will do; the
+member's name is appended to it.
+
+Writes to stdin block while the decompressor is busy, and the decompressor
+blocks while its output isn't taken, so a slow consumer holds up the stream
+just as it would for stored members.  Time the stream spent blocked on the
+decompressor is counted in ``stall_time``, separately from the download.
+"""
+
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+log = logging.getLogger('nzbstream.extract')
+
+DEFAULT_COMMAND = ['bsdtar', '-xOf', '-']   # Reads the archive on stdin
+CHUNK_SIZE      = 256 * 1024                # 256 KB, in bytes
+
+class Extractor(object):
+    """
+    Decompresses the member of ``rarfile`` with ``command``.  ``feed`` takes
+    the bytes of the volumes, in order, and blocks while the decompressor
+    is behind.  Extracted bytes are written to ``rarfile`` as they come.
+    """
+    def __init__(self, rarfile, command=DEFAULT_COMMAND):
+        # Archives use '\' as the path separator, the decompressor '/'
+        member = rarfile.filename.replace('\\', '/').encode('utf-8')
+
+        self.rarfile    = rarfile
+        self.command    = list(command) + [member]
+        self.bytes_in   = 0     # Bytes of archive fed to the decompressor
+        self.bytes_out  = 0     # Bytes extracted
+        self.stall_time = 0     # Seconds feed() waited on the decompressor
+        self.error      = None
+
+        self._start     = None  # When the first byte was fed
+        self._end       = None  # When the last byte was extracted
+        self._stderr    = tempfile.TemporaryFile()
+        self._proc      = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE, stderr=self._stderr)
+        log.debug("Started %s" % ' '.join(self.command))
+
+        self._thread = threading.Thread(target=self._drain, name="Extract")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _drain(self):
+        fd = self._proc.stdout.fileno()
+        try:
+            while True:
+                data = os.read(fd, CHUNK_SIZE)
+                if not data:
+                    break
+                self.rarfile.write_at(self.bytes_out, data)
+                self.bytes_out += len(data)
+                self._end = time.time()
+        except (IOError, OSError), e:
+            log.error("Could not write %s: %s" % (self.rarfile.filename, e))
+            self.error = e
+            self._proc.kill()
+
+    def feed(self, data):
+        if self.error:
+            raise IOError("Extraction failed: %s" % self.error)
+        if self._start is None:
+            self._start = time.time()
+
+        start = time.time()
+        try:
+            self._proc.stdin.write(data)
+        except IOError, e:
+            # The decompressor has gone away; its exit status says why
+            self.close()
+            raise IOError("Extraction failed: %s" % (self.error or e))
+        self.stall_time += time.time()-start
+        self.bytes_in   += len(data)
+
+    def close(self):
+        """
+        Waits for the decompressor to finish.  Sets ``error`` if it failed.
+        """
+        if self._proc.stdin.closed:
+            return
+        try:
+            self._proc.stdin.close()
+        except IOError:
+            pass
+        self._thread.join()
+
+        if self._proc.wait() != 0 and not self.error:
+            self._stderr.seek(0)
+            message = self._stderr.read().strip() or "exit status %d" % self._proc.returncode
+            self.error = "%s: %s" % (self.command[0], message)
+            log.error("Could not extract %s: %s" % (self.rarfile.filename, self.error))
+        self._stderr.close()
+
+    def get_rate(self):
+        """
+        Returns the bytes extracted per second since the first byte was fed.
+        """
+        if not self._start or not self._end or self._end <= self._start:
+            return 0
+        return self.bytes_out/(self._end-self._start)
@@ -0,0 +1,134 @@
+"""
+Local HTTP endpoint for the file being extracted.
+
+Players can't do much with a file that is still growing on disk, but most of
+them can play from a URL and will use byte ranges to seek.  The server here
+exposes the extracted file with its final ``Content-Length``, taken from the
+rar header, and answers ``Range`` requests.  Ranges that haven't been
+downloaded yet are moved to the front of the download queue by
+``Manager.read_at``, so seeking works while the download is running.
+"""
+
+import BaseHTTPServer
+import logging
+import mimetypes
+import re
+import socket
+import SocketServer
+import threading
+import urllib
+
+log = logging.getLogger('nzbstream.httpserver')
+
+DEFAULT_HOST    = '127.0.0.1'
+DEFAULT_PORT    = 8080
+CHUNK_SIZE      = 64 * 1024 # 64 KB, in bytes
+RANGE_RE        = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def parse_range(header, size):
+    """
+    Parses a single byte range ``Range`` header.  Returns ``(start, end)``,
+    inclusive, or ``None`` if the range is invalid or not satisfiable.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        # Suffix range; the last ``end`` bytes
+        length = int(end)
+        if length == 0:
+            return None
+        return max(0, size-length), size-1
+
+    start = int(start)
+    end   = int(end) if end else size-1
+    if start >= size or end < start:
+        return None
+    return start, min(end, size-1)
+
+class StreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = "nzbstream"
+
+    def log_message(self, format, *args):
+        log.info("%s - %s" % (self.client_address[0], format % args))
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def _respond(self, send_body):
+        manager = self.server.manager
+        rarfile = manager.current_file
+        if not rarfile or self.path.split('?')[0] not in ('/', '/' + urllib.quote(rarfile.filename.encode('utf-8'))):
+            self.send_error(404)
+            return
+
+        size  = rarfile.file_size
+        start = 0
+        end   = size-1
+
+        header = self.headers.getheader('Range')
+        if header:
+            byte_range = parse_range(header, size)
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.end_headers()
+                return
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+
+        content_type = mimetypes.guess_type(rarfile.filename)[0] or 'application/octet-stream'
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end-start+1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        if not send_body:
+            return
+
+        log.debug("Serving bytes %d-%d" % (start, end))
+        offset = start
+        try:
+            while offset <= end:
+                # With a memory mapped file this is a slice of the mapping
+                data = manager.read_at(offset, min(CHUNK_SIZE, end-offset+1), view=True)
+                if not data:
+                    break
+                self.connection.sendall(data)
+                offset += len(data)
+        except socket.error, e:
+            # The player closed the connection, usually because it's seeking
+            log.debug("Client went away at %d: %s" % (offset, e))
+
+class StreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__(self, manager, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.manager = manager
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), StreamHandler)
+
+    def get_url(self):
+        host, port = self.server_address
+        return "http://%s:%d/%s" % (host, port, urllib.quote(self.manager.current_file.filename.encode('utf-8')))
+    url = property(get_url)
+
+    def start(self):
+        """
+        Serves requests from a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever, name="HTTP")
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -1,11 +1,13 @@
+import collections
+import fnmatch
 import hashlib
 import logging
-import pynzb
 import re
 import sys
-import urllib
+import time
 
-from nzbstream import nntp, rarset, par2
+from array import array
+from nzbstream import cache, extract, nntp, nzb, plain, rarset, rarspec, reader, scheduler, writer, par2
 
 try:
     from cStringIO import StringIO
@@ -16,7 +18,11 @@ log = logging.getLogger('nzbstream.manager')
 
 FILE_HASH16K_LENGTH = 16 * 1024 # 16 KB, in bytes
 PAR_RE = re.compile(r'(vol[\d\+]+).par2')
-BITRATE_STREAM_MULT = 2
+FAST_START_SEGMENTS = 10 # Segments of the guessed first volume to fetch early
+READ_POLL_INTERVAL  = 0.1 # Seconds between checks for data in read_at
+RECENT_SEGMENTS     = 8   # Consumed segments kept in memory for readers
+PIPE_QUEUE_SEGMENTS = 100 # Segments queued ahead of the stream when piping
+REPLAY_PRIORITY     = float('-inf') # Segments downloaded again go ahead of everything else
 
 def get_filename(subject):
     if '"' in subject:
@@ -26,21 +32,53 @@ def get_filename(subject):
     return subject
 
 class Manager(object):
-    def __init__(self, nzb_path, nntp_kwargs, max_bitrate=None, do_verify=True):
+    def __init__(self, nzb_path, nntp_kwargs, max_bitrate=None, do_verify=True, fast_start=False,
+                 use_cache=True, output=None, read_ahead=scheduler.DEFAULT_READ_AHEAD,
+                 buffer_target=scheduler.DEFAULT_BUFFER_TARGET, fsync=writer.DEFAULT_FSYNC,
+                 use_mmap=False, extract_command=extract.DEFAULT_COMMAND, rar_password=None,
+                 include=None, exclude=None, select=None):
         self.nzb_path     = nzb_path
         self.nntp_kwargs  = nntp_kwargs
         self.max_bitrate  = max_bitrate
         self.do_verify    = do_verify
+        self.fast_start   = fast_start
+        self.cache        = cache.NZBCache() if use_cache else None
+        self.output       = output # pipe.PipeOutput to stream to instead of disk
+        self.read_ahead   = read_ahead # Seconds of media fetched ahead of the player
+        self.buffer_target = buffer_target # Seconds of media the throttle keeps buffered
+        self.fsync        = fsync  # writer fsync policy for the extracted file
+        self.use_mmap     = use_mmap # Memory map the extracted file
+        self.extract_command = extract_command # Decompressor for compressed files
+        self.extractor    = None   # extract.Extractor of a compressed file
+        self.rar_password = rar_password # Password of encrypted files
+        self.include      = include  # Patterns of the rar members to extract
+        self.exclude      = exclude  # Patterns of the rar members to skip
+        self.select       = select   # Rarset to stream: its number in the listing or a name pattern
+        self.rarsets      = []       # (name, files, members) of every rarset in the NZB
+        self.selected     = None     # Index in rarsets of the one being streamed
+        self.plain        = False    # True if rarsets are media files that aren't archived
         self.current_file = None
+        self.startup_time = None  # Seconds taken by initialize()
 
         self.nzb_file    = None
         self.nzb         = None
         self.rs          = None
         self.server      = None
-        self.segments    = {}
+        self.table       = nzb.SegmentTable()
+        self.segments    = array('I') # Index in self.table of every stream segment
         self._segnum     = -1
         self._segment    = None
         self._segcount   = 0
+        self._recent     = collections.OrderedDict() # segnum -> data of recently consumed segments
+        self.layout      = None  # (payload offset, payload size, part size) of every rarchive
+        self.index       = None  # rarset.SeekIndex for the extracted file
+        self.plan        = None  # rarset.LayoutPlan of the stream segments
+        self.members     = None  # (part size, complete, files) of every rarchive, see rarset.MemberPlan
+        self._skips      = {}    # segnum -> payload bytes left out right before it
+        self._outstanding = None # Segment numbers not written yet, when writing by plan
+        self.scheduler   = None  # scheduler.ReadAheadScheduler for the stream segments
+        self.throttle    = None  # scheduler.BufferThrottle for the server
+        self._queued     = set() # Segment numbers already given to the server
 
     def log(self, msg, lvl=0):
         log.info(msg.replace('\n', ' '))
@@ -52,13 +90,12 @@ class Manager(object):
 
     def next_segment(self):
         segnum  = self._segnum+1
-        segment = self.segments.get(segnum)
-        if not segment:
+        if segnum >= len(self.segments):
             self.logn("[Error] Couldn't find segment %d" % segnum, 1)
             return False
 
         log.debug("Grabbing segment %d" % segnum)
-        self.server.add_segment(segment, segnum)
+        self.queue_segment(segnum)
         while True:
             # Loop until the server has downloaded the segment
             data = self.server.get_segment(segnum, timeout=2)
@@ -66,39 +103,98 @@ class Manager(object):
                 continue
             self._segment = data
             self._segnum  = segnum
+            self._remember(segnum, data)
             break
 
         log.debug("Got segment %d" % segnum)
         return self._segment
 
-    def initialize(self):
+    def queue_segment(self, segnum, priority=None):
+        """
+        Gives segment ``segnum`` to the server, unless it was already queued.
+        """
+        if segnum in self._queued:
+            return
+        self._queued.add(segnum)
+        self.add_segment(self.segments[segnum], segnum, priority)
+
+    def is_downloaded(self, segnum):
+        """
+        Returns True if segment ``segnum`` has been consumed by the stream or
+        is waiting in the server.
+        """
+        if self._outstanding is not None and segnum not in self._outstanding:
+            return True
+        return segnum <= self._segnum or self.server._articles.has_key(segnum)
+
+    def move_segment(self, segnum, priority):
+        """
+        Queues segment ``segnum`` at ``priority``, or moves it there if it's
+        still waiting in the queue.
+        """
+        if segnum in self._queued:
+            self.server.set_priority(segnum, priority)
+        else:
+            self.queue_segment(segnum, priority)
+
+    def _remember(self, segnum, data):
+        """
+        Keeps the data of a consumed segment around for readers that are just
+        behind the stream.
+        """
+        self._recent[segnum] = data
+        while len(self._recent) > RECENT_SEGMENTS:
+            self._recent.popitem(last=False)
+
+    def add_segment(self, index, order, priority=None):
+        """
+        Queues the segment at ``index`` in the segment table for download.
+        """
+        self.server.add_segment(self.table.message_id(index), order, priority)
+
+    def initialize(self, list_only=False):
         """
         Opens necessary files and determines if and how to resume a previous
         stream.  If this returns ``False``, no further attempt should be made
         to download this file.
+
+        With ``list_only`` set, only the first segment of every file is read,
+        enough to fill in ``rarsets``; see ``list_rarsets``.
         """
+        self.list_only = list_only
         self.logn("Initializing")
-        
+        self._start_time = time.time()
+
         self.log("Opening NZB...", 1)
         try:
-            #self.nzb_file = open(self.nzb_path)
-            self.nzb_file = urllib.urlopen(self.nzb_path)
+            self.nzb_file = nzb.open_nzb(self.nzb_path)
         except Exception, e:
             self.logn("\n[Error] Could not open NZB: %s" % e, 1)
             return False
-        self.logn("OK")
-
-        self.log("Parsing NZB...", 1)
-        try:
-            self.nzb = pynzb.nzb_parser.parse(self.nzb_file.read())
-        except Exception, e:
-            self.logn("\n[Error] Could not parse NZB: %s" % e, 1)
-            return False
-        self.logn("OK")
+        self.logn("OK%s" % (" (gzip)" if self.nzb_file.compressed else ""))
 
+        # The server is started before the NZB is parsed so that requests can
+        # be issued while the rest of the NZB is still loading.
         self.logn("Connecting to server (%d threads)" % (self.nntp_kwargs.get('threads',1)), 1)
         self.server = nntp.NNTP(**self.nntp_kwargs)
 
+        # Cache entries are keyed by the content hash, so the NZB has to be
+        # read in full before we know if there is one.  That costs us the
+        # overlap between loading and parsing, so only do it for NZBs that have
+        # been cached before.
+        if self.cache and self.cache.known(self.nzb_path):
+            self.log("Checking cache...", 1)
+            data  = self.nzb_file.read()
+            entry = self.cache.load(self.nzb_file.hexdigest())
+            if entry and not list_only and self._select_rarset(entry.rarsets) != entry.selected:
+                # Only the headers of the rarset streamed last time are cached
+                self.logn("found, for another rarset")
+            elif entry:
+                self.logn("found")
+                return self._load_cache(entry)
+            else:
+                self.logn("not found")
+            self.nzb_file = nzb.NZBReader(StringIO(data))
 
         # Some posters rename the rarchives after they have been created and the
         # NZB will actually refer to the renamed name.  For example:
@@ -120,25 +216,46 @@ class Manager(object):
         # every file and compute it's MD5 hash.  We then parse the parity file
         # and rename the files by matching the MD5 hashes in the parity file
         # with those that we've calculated.
+        #
+        # The first segment of every file is queued as soon as the parser has
+        # read the file from the NZB.
         self.logn("Determining proper filenames and ordering", 1)
-        self.log("Grabbing segments for MD5 hashes...", 2)
-        for i, f in enumerate(self.nzb):
-            self.server.add_segment(f.segments[0], i)
-        self.logn("done")
+        self.log("Parsing NZB and grabbing segments for MD5 hashes...", 2)
+        self.nzb = []
+        try:
+            for i, f in enumerate(nzb.iterparse(self.nzb_file, self.table)):
+                f.filename = get_filename(f.subject)
+                self.add_segment(f.segments[0], ('head', i), i)
+                self.nzb.append(f)
+        except Exception, e:
+            self.logn("\n[Error] Could not parse NZB: %s" % e, 2)
+            return False
+        finally:
+            self.nzb_file.close()
+        self.logn("done (%d files, %d segments)" % (len(self.nzb), len(self.table)))
+
+        # In fast start mode we don't wait for the ordering to be worked out
+        # before grabbing data.  The most likely first volume according to the
+        # filenames is queued alongside the discovery segments, so its data is
+        # usually ready by the time the proper order is known.
+        guess = None
+        if self.fast_start:
+            guess = self._start_guess()
 
         self.log("Generating MD5 hashes...", 2)
         hash_map = {}
         file_map = {}
+        head_map = {}
         par_files = []
         for i, f in enumerate(self.nzb):
             while True:
-                data = self.server.get_segment(i, 2)
+                data = self.server.get_segment(('head', i), timeout=2)
                 if not data:
                     continue
 
-                filename = get_filename(f.subject)
-                f.filename = filename
+                filename = f.filename
                 file_map[filename] = data
+                head_map[i] = data
                 hash_map[filename] = hashlib.md5(data[:FILE_HASH16K_LENGTH]).digest()
                 if filename.endswith('.par2') and not PAR_RE.search(filename):
                     log.debug("Found par2: %s" % filename)
@@ -162,35 +279,395 @@ class Manager(object):
                                         break
                                 break
 
-        self.logn("Looking for rar archives in NZB", 1)
-        self.rs = rarset.RarSet(self.nzb)
+        # The filenames, even after being mapped through the par2 files, are
+        # only a guess at the proper ordering.  The rar headers themselves
+        # tell us which volume comes first and the number of every volume, so
+        # use those whenever the archiver stored them.  This also means posts
+        # without par2 files can still be ordered.
+        self.log("Reading rar volume headers...", 2)
+        volumes = self._read_volumes(head_map)
+        self.logn("done")
+
+        # NZBs such as season packs hold a rarset per episode.  Only the
+        # selected one is ordered and streamed.
+        self.rarsets = rarset.group_rarsets([volume.file for volume in volumes], volumes)
+        if not self.rarsets:
+            # Posts of the media file itself, whole or split, are streamed as is
+            self.rarsets = plain.find_sets(self.nzb, head_map)
+            self.plain   = bool(self.rarsets)
+        if list_only:
+            return True
+        if not self._choose_rarset():
+            return False
+        name, files, members = self.rarsets[self.selected]
+
+        if self.plain:
+            self.logn("No rar archives; streaming %s directly" % name, 1)
+            self._open_plain(name, files, head_map)
+        else:
+            files   = set(id(f) for f in files)
+            volumes = [volume for volume in volumes if id(volume.file) in files]
+
+            self.log("Reading rar volume numbers...", 2)
+            self._read_tails(volumes, head_map)
+            self.logn("done")
+
+            self.logn("Looking for rar archives in NZB", 1)
+            self.rs = rarset.RarSet(self.rarsets[self.selected][1], volumes, output=self.output,
+                                    fsync=self.fsync, use_mmap=self.use_mmap,
+                                    password=self.rar_password, include=self.include,
+                                    exclude=self.exclude)
+            self.members = self._get_members(volumes)
+            self.layout = self._get_layout(volumes)
+
+            if len(self.rs.rarchives) == 0:
+                self.logn("[Error] No rar archives found", 1)
+                return False
+
+        guessed = self.segments
+        self._build_segments()
+        if guess is not None:
+            self._check_guess(guess, guessed)
+
+        self.startup_time = time.time()-self._start_time
+        if self.cache:
+            self._store_cache()
+
+        self.logn("Initialization OK (%.2fs)" % self.startup_time, 1)
+        return True
+
+    def _select_rarset(self, rarsets):
+        """
+        Returns the index in ``rarsets``, ``(name, files, members)`` as in
+        ``self.rarsets``, of the rarset picked by ``select``: either its number
+        in the listing, starting from 1, or a pattern (``fnmatch``, ignoring
+        case) its name or one of its members matches.  Without a pick that's
+        the first one.  Returns ``None`` if there's no such rarset.
+        """
+        if not rarsets:
+            return None
+        if not self.select:
+            return 0
+        if self.select.isdigit():
+            index = int(self.select)-1
+            return index if 0 <= index < len(rarsets) else None
+        pattern = self.select.lower()
+        for index, (name, files, members) in enumerate(rarsets):
+            if any(fnmatch.fnmatch(n.lower(), pattern) for n in [name]+members):
+                return index
+        return None
+
+    def _choose_rarset(self):
+        """
+        Sets ``selected`` to the rarset picked by ``select``.  Returns ``False``
+        if there's no such rarset.
+        """
+        if not self.rarsets:
+            self.logn("[Error] No rar archives or media files found", 1)
+            return False
 
-        if len(self.rs.rarchives) == 0:
-            self.logn("[Error] No rar archives found", 1)
+        self.selected = self._select_rarset(self.rarsets)
+        if self.selected is None:
+            self.logn("[Error] No rarset matches '%s'; see --list" % self.select, 1)
             return False
+        if len(self.rarsets) > 1:
+            self.logn("Found %d %s; streaming %s" % (len(self.rarsets), "media files" if self.plain else "rarsets",
+                                                     self.rarsets[self.selected][0]), 1)
+        return True
 
+    def list_rarsets(self):
+        """
+        Returns ``(number, name, volumes, size, members)`` of every rarset, as
+        numbered for ``select``.  ``size`` is the encoded size in bytes and
+        ``members`` the names of the files in the rarset seen so far.
+        """
+        listing = []
+        for number, (name, files, members) in enumerate(self.rarsets):
+            listing.append((number+1, name, len(files), sum(f.size for f in files), members))
+        return listing
+
+    def _build_segments(self):
         # TODO: Read in possible resume file, and continue from a particular
         #       segment rather than from the beginning.
-        num_segments = 0
+        # Segments holding nothing but members that aren't wanted are left
+        # out.  When the rarset is a single wanted member, the one case that
+        # gets a layout, every segment is streamed.
+        counts = [rarfile.count for rarfile in self.rs.rarchives]
+        member_plan = None
+        if self.members and not rarset.get_single_member(self.members, self.rs.wants):
+            member_plan = rarset.MemberPlan(self.members, counts, self.rs.wants)
+
+        self.segments = array('I')
+        self._skips   = {}
+        segnum = 0
+        for rarfile in self.rs.rarchives:
+            for index in rarfile.segments:
+                if member_plan and segnum in member_plan.dropped:
+                    segnum += 1
+                    continue
+                if member_plan and segnum in member_plan.skips:
+                    self._skips[len(self.segments)] = member_plan.skips[segnum]
+                self.segments.append(index)
+                segnum += 1
+        self._segcount = len(self.segments)
+        self.logn("Found %d rar files and %d segments" % (len(self.rs.rarchives), self._segcount), 2)
+        if member_plan and member_plan.dropped:
+            self.logn("Leaving out %d segments (~%.1f MB) of unwanted files" % (
+                      len(member_plan.dropped), member_plan.saved/1048576.0), 2)
+
+        # A pipe only takes data as fast as the other end reads it, so there we
+        # only keep a window of segments queued ahead of the stream; otherwise
+        # the downloaded segments would pile up in memory.
+        self.scheduler = scheduler.ReadAheadScheduler(self, self.read_ahead,
+                                                      PIPE_QUEUE_SEGMENTS if self.output else None)
+        self.throttle  = scheduler.BufferThrottle(self.server, self.scheduler, self.buffer_target)
+
+        if self.layout:
+            self.index = rarset.SeekIndex()
+            segnum = 0
+            for rarfile, (offset, size, part_size) in zip(self.rs.rarchives, self.layout):
+                self.index.add_volume(offset, size, part_size, segnum)
+                segnum += rarfile.count
+            log.debug("Built seek index over %d bytes" % self.index.size)
+            self.plan = rarset.LayoutPlan(self.index, [rarfile.count for rarfile in self.rs.rarchives])
+
+    def _get_members(self, volumes):
+        """
+        Returns ``(part_size, complete, files)`` of every rarchive, as read
+        from its first segment, for a ``rarset.MemberPlan``.  Rarchives whose
+        headers weren't read have ``None``.
+        """
+        volumes = dict((id(v.file), v) for v in volumes)
+        members = []
         for rarfile in self.rs.rarchives:
-            for segment in rarfile.segments:
-                #server.add_segment(segment, num_segments)
-                self.segments[num_segments] = segment
-                num_segments += 1
-        self._segcount = num_segments
-        self.logn("Found %d rar files and %d segments" % (len(self.rs.rarchives), num_segments), 2)
-
-        self.logn("Initialization OK", 1)
+            volume = volumes.get(id(rarfile))
+            if volume and volume.is_rar:
+                members.append((volume.part_size, volume.complete, volume.get_members()))
+            else:
+                members.append(None)
+        return members
+
+    def _read(self, segnum, data):
+        """
+        Parses stream segment ``segnum``, after skipping the payload of the
+        segments left out before it.
+        """
+        if segnum in self._skips:
+            self.rs.skip(self._skips[segnum])
+        return self.rs.read(data)
+
+    def _get_layout(self, volumes):
+        """
+        Returns where the extracted file's data sits in every rarchive, or
+        ``None`` if the headers don't tell us.  Only rarsets holding a single,
+        wanted file are supported; other members have to go through
+        ``RarSet.read`` to be extracted.
+        """
+        if not rarset.get_single_member(self.members, self.rs.wants):
+            log.debug("Not a single wanted file in rarset; no seek index")
+            return None
+
+        volumes  = dict((id(v.file), v) for v in volumes)
+        layout   = []
+        for rarfile in self.rs.rarchives:
+            volume  = volumes.get(id(rarfile))
+            payload = volume.get_payload() if volume else None
+            if not payload:
+                return None
+
+            offset, size, name = payload
+            layout.append((offset, size, volume.part_size))
+        return layout
+
+    def seek(self, offset):
+        """
+        Moves the read position to byte ``offset`` of the extracted file; the
+        scheduler gives the segments from there on the earliest deadlines.
+        Returns the segment number holding ``offset`` or ``None`` if there's no
+        index.
+        """
+        if not self.index:
+            return None
+
+        volume, segnum, seg_offset = self.index.locate(offset)
+        if segnum != self.scheduler.position:
+            log.debug("Seek to %d: volume %d, segment %d, offset %d" % (offset, volume, segnum, seg_offset))
+        self.scheduler.seek(segnum)
+        return segnum
+
+    def _store_cache(self):
+        index = dict((id(f), i) for i, f in enumerate(self.nzb))
+        rarsets = [(name, [index[id(f)] for f in files], members)
+                   for name, files, members in self.rarsets]
+        entry = cache.CacheEntry(self.table, self.nzb,
+                                 [index[id(f)] for f in self.rs.rarchives],
+                                 self.layout, self.startup_time, self.members,
+                                 rarsets, self.selected, self.plain)
+        try:
+            self.cache.store(self.nzb_file.hexdigest(), self.nzb_path, entry)
+        except Exception, e:
+            log.error("Could not store cache entry: %s" % e)
+
+    def _load_cache(self, entry):
+        """
+        Restores the segment table, filenames and volume order from a cache
+        entry instead of parsing the NZB and fetching the headers.
+        """
+        self.table = entry.table
+        self.nzb   = entry.files
+        self.rarsets = [(name, [self.nzb[i] for i in files], members)
+                        for name, files, members in entry.rarsets]
+        if self.list_only:
+            return True
+        self.selected = entry.selected
+        self.plain    = entry.plain
+        if len(self.rarsets) > 1:
+            self.logn("Found %d %s; streaming %s" % (len(self.rarsets), "media files" if self.plain else "rarsets",
+                                                     self.rarsets[self.selected][0]), 1)
+        if self.plain:
+            self.rs = plain.PlainSet(self.rarsets[self.selected][0], [self.nzb[i] for i in entry.rarchives],
+                                     sum(size for offset, size, part_size in entry.layout),
+                                     self.output, self.fsync, self.use_mmap)
+        else:
+            self.rs = rarset.RarSet(self.nzb, rarchives=[self.nzb[i] for i in entry.rarchives],
+                                    output=self.output, fsync=self.fsync, use_mmap=self.use_mmap,
+                                    password=self.rar_password, include=self.include,
+                                    exclude=self.exclude)
+        self.members = entry.members
+        self.layout = entry.layout
+        if not self.plain and not rarset.get_single_member(self.members, self.rs.wants):
+            # Stored for other include and exclude patterns
+            self.layout = None
+        self._build_segments()
+
+        self.startup_time = time.time()-self._start_time
+        self.logn("Loaded from cache in %.2fs, saving ~%.2fs of startup" % (
+                  self.startup_time, max(0, entry.startup-self.startup_time)), 2)
+        self.logn("Initialization OK (%.2fs)" % self.startup_time, 1)
         return True
 
+    def _start_guess(self):
+        """
+        Queues the first segments of the most likely first rarchive, going by
+        filenames alone, under the segment numbers they would have if the guess
+        is right.  Returns the guessed rarchive or ``None``.
+        """
+        first = rarset.guess_first_rarchive(self.nzb)
+        if first is None:
+            return None
+
+        self.logn("Fast start: guessing %s is the first volume" % first.filename, 2)
+        self.segments = array('I', first.first_segments(FAST_START_SEGMENTS))
+        for segnum in range(len(self.segments)):
+            self.queue_segment(segnum)
+        return first
+
+    def _check_guess(self, guess, guessed):
+        """
+        Keeps the segments queued by ``_start_guess`` if the guessed rarchive
+        really is the first volume, otherwise cancels them so they are fetched
+        again in the proper order.  ``guessed`` has their indices in the
+        segment table.  Segments left out by the member plan move the ones
+        after them to other segment numbers, so those are cancelled too.
+        """
+        if self.rs.rarchives and self.rs.rarchives[0] is guess:
+            self.logn("Fast start: guess was correct", 2)
+            for segnum in list(self._queued):
+                if segnum >= len(self.segments) or self.segments[segnum] != guessed[segnum]:
+                    log.debug("Fast start: segment %d has moved" % segnum)
+                    self.server.cancel(segnum)
+                    self._queued.discard(segnum)
+            return
+
+        self.logn("Fast start: first volume is %s, discarding guess" % self.rs.rarchives[0].filename, 2)
+        for segnum in list(self._queued):
+            self.server.cancel(segnum)
+        self._queued.clear()
+
+    def _read_volumes(self, head_map):
+        """
+        Returns a list of ``rarset.RarVolume`` built from the first segment of
+        every rar file.  See ``_read_tails`` for the rest of the headers.
+        """
+        volumes = []
+        for i, f in enumerate(self.nzb):
+            head = head_map[i]
+            if not rarspec.is_rar_data(head):
+                continue
+            volumes.append(rarset.RarVolume(f, head))
+        return volumes
+
+    def _read_tails(self, volumes, head_map):
+        """
+        Grabs the last segment of every volume in ``volumes`` that starts with
+        a RAR 1.5-4.x marker, for the volume number in the end of archive
+        block.  RAR5 volumes store their number in the main header instead,
+        but their last segment is grabbed too when the first didn't hold all
+        of their file headers.  Only the volumes of the rarset being streamed
+        are read.
+        """
+        volumes = [volume for volume in volumes if not volume.rar5 or not volume.complete]
+        tails   = self._get_tails([volume.file for volume in volumes], head_map)
+        for volume, tail in zip(volumes, tails):
+            volume.add_tail(tail)
+            log.debug("Read headers for %s: first=%s, number=%s" % (
+                      volume.file.filename, volume.first_volume, volume.volume_number))
+
+    def _get_tails(self, files, head_map):
+        """
+        Returns the last segment of every file in ``files``, grabbing them
+        all at once.  That's the first segment for single segment files.
+        """
+        index = dict((id(f), i) for i, f in enumerate(self.nzb))
+        for f in files:
+            i = index[id(f)]
+            if len(f.segments) > 1:
+                self.add_segment(f.segments[-1], ('tail', i), i)
+
+        tails = []
+        for f in files:
+            i    = index[id(f)]
+            tail = head_map[i]
+            if len(f.segments) > 1:
+                while True:
+                    tail = self.server.get_segment(('tail', i), timeout=2)
+                    if tail:
+                        break
+            tails.append(tail)
+        return tails
+
+    def _open_plain(self, name, parts, head_map):
+        """
+        Sets up streaming the media file ``name`` from ``parts``, which aren't
+        archived.  Every segment but the last of a part has the size of the
+        first, so the last segments give the size of every part, and with it
+        the layout for seeking.
+        """
+        index = dict((id(f), i) for i, f in enumerate(self.nzb))
+        self.log("Reading part sizes...", 2)
+        tails = self._get_tails(parts, head_map)
+        self.logn("done")
+
+        self.layout = []
+        for f, tail in zip(parts, tails):
+            head = head_map[index[id(f)]]
+            size = len(head)*(len(f.segments)-1)+len(tail) if len(f.segments) > 1 else len(head)
+            self.layout.append((0, size, len(head)))
+        self.members = None
+        self.rs = plain.PlainSet(name, parts, sum(size for offset, size, part_size in self.layout),
+                                 self.output, self.fsync, self.use_mmap)
+
     def verify(self):
         """
         Attempts to verify that this file is capable of being streamed.  The
         following items are always checked:
 
-            *   Rar files do not use compression.
             *   Rar files contain a media file
 
+        Compressed files are streamed through ``extract_command``.  Encrypted
+        files are decrypted with ``rar_password``, provided they're stored
+        and use RAR3 encryption.
+
         These checks are optional:
 
             *   If ``do_verify`` is True, a check will be made to ensure that
@@ -202,44 +679,52 @@ class Manager(object):
         
         # Let's first check that the rar files do not use compression
         self.logn("Looking for rar header", 1)
-        while True:
+        found = None
+        while not self.rs.main_file:
             data = self.next_segment()
+            if not data:
+                # Every member was filtered out, or none is media
+                self.logn("[Error] No media file to stream found", 1)
+                return False
 
             # Parse the data
-            self.rs.read(data)
-            if self.rs.current_file:
-                if self.rs.current_file != self.current_file:
-                    self.current_file = self.rs.current_file
-                    self.logn("Found file: %s" % self.rs.current_file.filename, 2)
-
-                    if self.current_file.is_media():
-                        self.logn("File is a valid media type")
-                    else:
-                        self.logn("File is not a valid media type")
-                        continue
-
-                # See if we need to check the bitrate
-                if self.max_bitrate is not None:
-                    
-                    self.logn("Checking bitrate", 2)
-                    bitrate = self.current_file.get_bitrate()
-                    while not bitrate:
-                        segment = self.next_segment()
-                        if not segment:
-                            self.logn("[Error] Couldn't find segment", 2)
-                            return False
-
-                        self.rs.read(data)
-
-                        bitrate = self.rs.current_file.get_bitrate()
-
-                    self.logn("Bitrate is %s" % nntp.sizeof_fmt(bitrate), 3)
-                    if self.max_bitrate < bitrate:
-                        self.logn("[Error] Bitrate exceeds user-defined max of %s" % nntp.sizeof_fmt(self.max_bitrate), 3)
-                        return False
-                    self.logn("Bitrate is <= %s" % nntp.sizeof_fmt(self.max_bitrate), 3)
-                    break
-            break
+            self._read(self._segnum, data)
+            if self.rs.current_file and self.rs.current_file != found:
+                found = self.rs.current_file
+                self.logn("Found file: %s" % found.filename, 2)
+                if found != self.rs.main_file:
+                    self.logn("File is not a valid media type")
+
+        self.current_file = self.rs.main_file
+        self.logn("File is a valid media type")
+
+        if self.current_file.compressed:
+            self.logn("File is compressed; extracting with %s" % self.extract_command[0], 2)
+
+        if self.current_file.encrypted and not self._check_encryption():
+            return False
+
+        # See if we need to check the bitrate.  That of a compressed
+        # file isn't known until some of it has been extracted.
+        if self.max_bitrate is not None and not self.current_file.compressed:
+            
+            self.logn("Checking bitrate", 2)
+            bitrate = self.current_file.get_bitrate()
+            while not bitrate:
+                segment = self.next_segment()
+                if not segment:
+                    self.logn("[Error] Couldn't find segment", 2)
+                    return False
+
+                self._read(self._segnum, segment)
+
+                bitrate = self.current_file.get_bitrate()
+
+            self.logn("Bitrate is %s" % nntp.sizeof_fmt(bitrate), 3)
+            if self.max_bitrate < bitrate:
+                self.logn("[Error] Bitrate exceeds user-defined max of %s" % nntp.sizeof_fmt(self.max_bitrate), 3)
+                return False
+            self.logn("Bitrate is <= %s" % nntp.sizeof_fmt(self.max_bitrate), 3)
 
         if self.do_verify:
             self.logn('Verifying rar segments...', 1)
@@ -248,42 +733,275 @@ class Manager(object):
 
         return True
 
+    def _check_encryption(self):
+        """
+        Returns True if the current file, which is encrypted, can be decrypted.
+        """
+        if self.rar_password is None:
+            self.logn("[Error] File is encrypted; a password is required", 2)
+        elif not rarspec._have_crypto:
+            self.logn("[Error] File is encrypted; decrypting it requires pycryptodome", 2)
+        elif self.current_file.compressed:
+            self.logn("[Error] File is encrypted and compressed; only stored files can be decrypted", 2)
+        elif not self.current_file.decrypting:
+            self.logn("[Error] File is encrypted; only RAR3 encryption is supported", 2)
+        else:
+            self.logn("File is encrypted; decrypting", 2)
+            return True
+        return False
+
     def stream(self):
         self.logn("Starting stream")
         segnum  = self._segnum+1
         bitrate = None
 
         self.logn("Queuing segments", 1)
-        while segnum < self._segcount:
-            segment = self.segments[segnum]
-            self.server.add_segment(segment, segnum)
-            segnum += 1
-
-        while self._segnum < self._segcount:
+        if self.current_file.compressed:
+            # The decompressor takes data as fast as it extracts it, so as
+            # with a pipe only a window of segments is queued ahead
+            self.scheduler.background = PIPE_QUEUE_SEGMENTS
+            self.scheduler.start(segnum)
+            return self._stream_extracted()
+        self.scheduler.start(segnum)
+
+        # Segments can go straight to their place in the extracted file when
+        # the layout is known, unless the output is a pipe, which has to be
+        # written in order.
+        if self.plan and self.current_file.path:
+            return self._stream_planned()
+
+        # Every member of the rarset is extracted in the same pass, so the
+        # stream runs to the end of the segments, not just of the first file
+        while self._segnum+1 < self._segcount:
             segnum  = self._segnum+1
             while True:
-                data = self.server.get_segment(segnum, 2)
+                data = self.server.get_segment(segnum, timeout=2)
+                self.throttle.update()
                 if not data:
                     self.display_progress()
                     continue
 
-                ret = self.rs.read(data)
+                self._remember(segnum, data)
+                ret = self._read(segnum, data)
                 if not bitrate:
-                    bitrate = self.current_file.get_bitrate()
-                    if bitrate:
-                        self.logn("Bitrate is %s" % nntp.sizeof_fmt(bitrate), 2)
-                        self.logn("Setting download throttle to ~%s" % nntp.sizeof_fmt(bitrate*BITRATE_STREAM_MULT), 2)
-                        self.server.set_throttle(bitrate*BITRATE_STREAM_MULT)
+                    bitrate = self._check_bitrate()
 
                 self.display_progress()
-
-                if self.current_file.complete:
-                    self.logn("\nStream complete!")
-                    return
                 break
 
             self._segnum = segnum
+            self.scheduler.advance(segnum)
+
+        if self.current_file.complete:
+            self._stream_complete()
+        else:
+            self.logn("\n[Error] Stream ended with %s incomplete" % self.current_file.filename, 1)
+
+    def _stream_planned(self):
+        """
+        Writes every segment to its place in the extracted file, as given by
+        the layout plan, as soon as it's downloaded.  Segments finishing out of
+        order no longer wait for the ones before them.
+        """
+        bitrate = None
+        self._outstanding = set(xrange(self._segnum+1, self._segcount))
+        while self._outstanding:
+            ready = self.server.get_segments(self._outstanding, 2, hedge=self._segnum+1)
+            self.throttle.update()
+            for segnum, data in ready:
+                self._outstanding.discard(segnum)
+                self._remember(segnum, data)
+                start, end, dest = self.plan.get(segnum)
+                if end > start:
+                    self.current_file.write_at(dest, memoryview(data)[start:end])
+
+            # The stream position is the end of the contiguous written prefix
+            while self._segnum+1 < self._segcount and self._segnum+1 not in self._outstanding:
+                self._segnum += 1
+                self.scheduler.advance(self._segnum)
+
+            if ready and not bitrate:
+                bitrate = self._check_bitrate()
+            self.display_progress()
+
+            if self.current_file.complete:
+                self._stream_complete()
+                return
+
+    def _stream_extracted(self):
+        """
+        Feeds every segment, in order, to the decompressor, which writes the
+        extracted file.  Feeding blocks while the decompressor is behind.
+        """
+        self.extractor = extract.Extractor(self.current_file, self.extract_command)
+
+        try:
+            # The segments read by verify() haven't been extracted yet
+            self._replay(self._segnum+1)
+
+            bitrate = None
+            while self._segnum+1 < self._segcount:
+                segnum = self._segnum+1
+                data   = self.server.get_segment(segnum, timeout=2)
+                self.throttle.update()
+                if data:
+                    self._remember(segnum, data)
+                    self.extractor.feed(data)
+                    self._read(segnum, data)  # Stored members other than this one
+                    self._segnum = segnum
+                    self.scheduler.advance(segnum)
+
+                if not bitrate and self.current_file.tell():
+                    bitrate = self._check_bitrate()
+                self.display_progress()
+        except IOError, e:
+            self.logn("\n[Error] %s" % e, 1)
+            return
+
+        self.extractor.close()
+        if self.extractor.error:
+            self.logn("\n[Error] Extraction failed: %s" % self.extractor.error, 1)
+        elif not self.current_file.complete:
+            self.logn("\n[Error] Extracted %d of %d bytes" % (self.extractor.bytes_out, self.current_file.file_size), 1)
+        else:
+            self._stream_complete()
+
+    def _replay(self, count):
+        """
+        Feeds the first ``count`` segments to the decompressor again.  Only
+        the most recent are still in memory; the rest are downloaded again,
+        a window of ``PIPE_QUEUE_SEGMENTS`` ahead at a time.
+        """
+        missing = [segnum for segnum in xrange(count) if segnum not in self._recent]
+        if missing:
+            self.logn("Downloading %d segments again for the decompressor" % len(missing), 1)
+
+        queued = 0
+        for segnum in xrange(count):
+            while queued < len(missing) and missing[queued] < segnum+PIPE_QUEUE_SEGMENTS:
+                self.add_segment(self.segments[missing[queued]], ('replay', missing[queued]), REPLAY_PRIORITY)
+                queued += 1
+
+            data = self._recent.get(segnum)
+            while data is None:
+                data = self.server.get_segment(('replay', segnum), timeout=2)
+            self.extractor.feed(data)
+
+    def _check_bitrate(self):
+        """
+        Hands the bitrate of the extracted file, once it can be determined, to
+        the scheduler.  Returns the bitrate or 0.
+        """
+        bitrate = self.current_file.get_bitrate()
+        if bitrate:
+            self.logn("Bitrate is %s" % nntp.sizeof_fmt(bitrate), 2)
+            self.logn("Reading ahead %ds" % self.read_ahead, 2)
+            self.scheduler.set_bitrate(bitrate)
+            self.logn("Throttling download to keep ~%ds buffered" % self.buffer_target, 2)
+        return bitrate
+
+    def _stream_complete(self):
+        self.logn("\nStream complete!")
+        for name, progress in self.rs.get_progress():
+            if progress < 1:
+                self.logn("[Error] %s is incomplete (%.1f%%)" % (name, progress*100), 1)
+            elif name != self.current_file.filename:
+                self.logn("Extracted %s" % name, 1)
+        for name in sorted(self.rs.skipped):
+            self.logn("Skipped %s" % name, 1)
+        self.logn("Hedged %d of %d segments (%.1f%%), %d answered first" % (
+                  self.server.hedged, self.server.downloaded,
+                  self.server.get_hedge_rate()*100, self.server.hedge_wins), 1)
+        self.logn("Disk: %.2fs writing, consumer stalled %.2fs" % (
+                  self.current_file.disk_time, self.current_file.stall_time), 1)
+        if self.extractor:
+            self.logn("Decompression: %.1f MB extracted from %.1f MB at %s, stream waited %.2fs" % (
+                      self.extractor.bytes_out/1048576.0, self.extractor.bytes_in/1048576.0,
+                      nntp.sizeof_fmt(self.extractor.get_rate(), True), self.extractor.stall_time), 1)
+
+    def open(self, timeout=None):
+        """
+        Returns a blocking, seekable file-like object for the extracted file.
+        See ``reader.StreamReader``.
+        """
+        return reader.StreamReader(self, timeout)
+
+    def _get_memory(self, offset, size):
+        # Segments consumed by the stream are kept around for a little while
+        # and segments downloaded ahead of it wait in the server; either way
+        # the bytes can be sliced out without touching the disk.
+        volume, segnum, seg_offset, length = self.index.span(offset)
+        data = self._recent.get(segnum)
+        if data is None:
+            data = self.server.get_segment(segnum, remove=False, timeout=0)
+        if data is None:
+            return None
+        return data[seg_offset:seg_offset+min(size, length)]
+
+    def is_available(self, offset):
+        """
+        Returns True if byte ``offset`` of the extracted file can be read
+        without waiting.
+        """
+        if self.current_file.get_written(offset):
+            return True
+        return self.index is not None and self._get_memory(offset, 1) is not None
+
+    def read_at(self, offset, size, timeout=None, view=False):
+        """
+        Returns up to ``size`` bytes of the extracted file starting at
+        ``offset``, blocking until they're available.  Bytes still held in
+        memory are returned from there, bytes already written are read from
+        disk.  Otherwise the segment holding ``offset`` is moved to the front of
+        the download queue and the bytes are sliced out of the segment as soon
+        as it arrives, so readers don't wait for everything before ``offset``.
+        Returns ``None`` on timeout.
+
+        With ``view`` set, written bytes of a memory mapped file are returned
+        as a slice of the mapping rather than a string.
+        """
+        rarfile = self.current_file
+        if offset >= rarfile.file_size:
+            return ''
+        size  = min(size, rarfile.file_size-offset)
+        start = time.time()
+
+        # Tell the scheduler where the reader is, even if the data is here
+        # already, so the read-ahead window follows the reader.
+        if self.index:
+            segnum = self.seek(offset)
+
+        while True:
+            if view:
+                data = rarfile.view(offset, size)
+                if data is not None:
+                    return data
+
+            if self.index:
+                data = self._get_memory(offset, size)
+                if data:
+                    return data
+
+            written = rarfile.get_written(offset)
+            if written:
+                with open(rarfile.path, 'rb') as f:
+                    f.seek(offset)
+                    return f.read(min(size, written))
+            if not rarfile.path and offset < rarfile._total_written:
+                raise IOError("Byte %d of %s has already been piped out" % (offset, rarfile.filename))
+
+            if self.index:
+                self.server.get_segment(segnum, remove=False, timeout=READ_POLL_INTERVAL)
+            else:
+                time.sleep(READ_POLL_INTERVAL)
+
+            if timeout is not None and time.time()-start > timeout:
+                return None
 
     def display_progress(self):
         sys.stdout.write("\rProgress: %0.2f%%, Rate: %12s" % ((self.current_file.get_progress()*100), self.server.get_speed(True)))
+        # The other members of the rarset, if any
+        for name, progress in self.rs.get_progress():
+            if name != self.current_file.filename:
+                sys.stdout.write(" | %s %d%%" % (name.replace('\\', '/').rsplit('/', 1)[-1], progress*100))
         sys.stdout.flush()
@@ -1,9 +1,12 @@
 from nzbverify import nntp
 from nntplib import NNTPError, NNTPPermanentError, NNTPTemporaryError
 
+import collections
+import itertools
 import logging
 import Queue
 import re
+import socket
 import threading
 import time
 import _yenc
@@ -12,6 +15,11 @@ YSPLIT_RE = re.compile(r'([a-zA-Z0-9]+)=')
 gUTF      = True
 TIME_SEP  = 0.5
 
+LATENCY_SAMPLES     = 200           # Article latencies kept for the hedge threshold
+HEDGE_PERCENTILE    = 95            # Latency percentile after which a segment is hedged
+HEDGE_MIN_SAMPLES   = 10            # Latencies needed before hedging
+HEDGE_PRIORITY      = float('-inf') # Hedges go ahead of everything else
+
 log = logging.getLogger('nzbstream.nntp')
 
 def sizeof_fmt(num, bytes=False):
@@ -119,6 +127,20 @@ def decode(data):
 
         return decoded_data
 
+class Hedge(object):
+    """
+    A duplicate request for a segment that's taking too long.  Whichever of
+    the original request (``primary``) and the hedge (``seq``) answers first
+    wins; the other one is skipped if it's still queued or its result dropped
+    if it's being downloaded.
+    """
+    def __init__(self, order, primary, seq):
+        self.order   = order
+        self.primary = primary  # Sequence of the original request
+        self.seq     = seq      # Sequence of the hedge
+        self.thread  = None     # NNTPThread downloading the hedge
+        self.winner  = None     # Sequence of the request that answered first
+
 class NNTPThread(threading.Thread):
     """
     A thread for consuming message ids and decoding articles.
@@ -131,6 +153,7 @@ class NNTPThread(threading.Thread):
         self.articles    = owner._articles
         self.nntp_kwargs = nntp_kwargs
         self.conn        = None
+        self.current     = None     # (order, sequence) being downloaded
         self._halt       = False
 
         super(NNTPThread, self).__init__(name=name)
@@ -138,7 +161,21 @@ class NNTPThread(threading.Thread):
     def quit(self):
         log.debug("Thead quitting")
         self._halt = True
-        self.msg_ids.put((-1, None))
+        self.msg_ids.put((-1, -1, -1, None))
+
+    def abort(self):
+        """
+        Aborts the download in progress, if any, by shutting down the socket
+        under it.  The connection is opened again for the next segment.
+        """
+        sock = getattr(self.conn, 'sock', None)
+        if sock is None:
+            return
+        log.debug("Aborting download")
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except Exception, e:
+            log.debug("Could not abort: %s" % e)
 
     def get_conn(self):
         if not self.conn:
@@ -157,15 +194,22 @@ class NNTPThread(threading.Thread):
     def run(self):
         log.debug("Thread starting")
         while not self._halt:
-            order, message_id = None, None
+            priority, seq, order, message_id = None, None, None, None
             try:
                 conn = self.get_conn()
 
-                order, message_id = self.msg_ids.get()
-                if order == -1:
+                priority, seq, order, message_id = self.msg_ids.get()
+                if message_id is None:
                     self.close_conn()
                     break
 
+                if not self.owner._start(order, seq, self):
+                    # Cancelled, or queued again with a new priority
+                    log.debug("Skipping segment %s" % (order,))
+                    self.msg_ids.task_done()
+                    order, message_id = None, None
+                    continue
+
                 time.sleep(self.owner._delay)
 
                 start = time.time()
@@ -173,10 +217,12 @@ class NNTPThread(threading.Thread):
                 stop = time.time()
 
                 article = decode(article[3])
-                self.articles[order] = (article, start, stop)
+                self.owner._add_latency(stop-start)
+                if self.owner._finish(order, seq, thread=self):
+                    self.articles[order] = (article, start, stop)
                 self.owner.add_bytes(len(article))
                 self.msg_ids.task_done()
-                log.debug("Segment %d downloaded" % order)
+                log.debug("Segment %s downloaded" % (order,))
 
                 order, message_id = None, None
             except Queue.Empty:
@@ -196,10 +242,10 @@ class NNTPThread(threading.Thread):
                 log.error('%s: %s' %(type(e), e))
                 self.close_conn()
             finally:
-                if order and message_id:
+                if message_id is not None and self.owner._finish(order, seq, False, self):
                     # Put the message id back into the queue
                     log.debug("Putting message back in queue: (%s, %s)" % (order, message_id))
-                    self.msg_ids.put((order, message_id))
+                    self.owner._put(priority, order, message_id)
 
         log.debug("Thead quit")
 
@@ -221,6 +267,13 @@ class NNTP(object):
 
         self._msg_ids   = Queue.PriorityQueue()
         self._articles  = {}
+        self._pending   = {}    # order -> (sequence, msgid) of queued segments
+        self._inflight  = {}    # order -> sequence of segments being downloaded
+        self._dropped   = set() # Sequences of cancelled in-flight segments
+        self._started   = {}    # order -> (start time, msgid) of segments being downloaded
+        self._hedges    = {}    # order -> Hedge
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._sequence  = itertools.count()
         self._lock      = threading.Lock()
 
         self._throttle  = 0
@@ -229,52 +282,269 @@ class NNTP(object):
         self._total_bytes = 0
         self._start_time  = time.time()
 
+        self.downloaded   = 0   # Number of segments downloaded
+        self.hedged       = 0   # Number of hedges issued
+        self.hedge_wins   = 0   # Number of hedges that answered first
+
         self.connect()
 
-    def add_segment(self, segment, order=1):
-        msgid = "<%s>" % segment.message_id
-        self._msg_ids.put((order, msgid))
+    def add_segment(self, message_id, order=1, priority=None):
+        """
+        Queues the article ``message_id`` for download.  Once downloaded, the decoded article is
+        available from ``get_segment`` under ``order``, which may be any
+        hashable value.  Segments are downloaded lowest ``priority`` first,
+        which defaults to ``order``.
+        """
+        msgid = "<%s>" % message_id
+        if priority is None:
+            priority = order
+        self._put(priority, order, msgid)
+
+    def _put(self, priority, order, msgid):
+        self._lock.acquire()
+        try:
+            self._queue(priority, order, msgid)
+        finally:
+            self._lock.release()
+
+    def _queue(self, priority, order, msgid):
+        # The sequence number keeps equal priorities in FIFO order and stops
+        # the queue from ever comparing the orders themselves.  Only the most
+        # recent sequence of an order is downloaded; older queue entries for
+        # the same order are skipped.  Must be called with the lock held.
+        seq = next(self._sequence)
+        self._pending[order] = (seq, msgid)
+        self._msg_ids.put((priority, seq, order, msgid))
+
+    def _start(self, order, seq, thread=None):
+        self._lock.acquire()
+        try:
+            hedge = self._hedges.get(order)
+            if hedge is not None and hedge.seq == seq:
+                if hedge.winner is not None:
+                    # The original request answered first
+                    del self._hedges[order]
+                    return False
+                hedge.thread = thread
+            elif self._pending.get(order, (None,))[0] == seq:
+                self._started[order]  = (time.time(), self._pending.pop(order)[1], thread)
+                self._inflight[order] = seq
+            else:
+                return False
+            if thread is not None:
+                thread.current = (order, seq)
+            return True
+        finally:
+            self._lock.release()
+
+    def _finish(self, order, seq, ok=True, thread=None):
+        """
+        Returns True if the segment should be stored, or when ``ok`` is
+        False, queued again.
+        """
+        self._lock.acquire()
+        try:
+            if thread is not None and thread.current == (order, seq):
+                thread.current = None
+            primary = self._started.get(order, (None, None, None))[2]
+            if self._inflight.get(order) == seq:
+                del self._inflight[order]
+                self._started.pop(order, None)
+            if seq in self._dropped:
+                self._dropped.discard(seq)
+                return False
+
+            hedge = self._hedges.get(order)
+            if hedge is None or seq not in (hedge.primary, hedge.seq):
+                if ok:
+                    self.downloaded += 1
+                return True
+
+            if hedge.winner is not None:
+                # Lost the race, or was aborted because of it
+                del self._hedges[order]
+                return False
+
+            if not ok:
+                # A failed hedge is forgotten; a failed original is queued
+                # again and the hedge, if it answers, is dropped.
+                del self._hedges[order]
+                if seq == hedge.primary:
+                    self._dropped.add(hedge.seq)
+                    return True
+                return False
+
+            hedge.winner = seq
+            self.downloaded += 1
+            if seq == hedge.seq:
+                self.hedge_wins += 1
+                log.debug("Hedge won for segment %s" % (order,))
+                loser, loser_seq = primary, hedge.primary
+            else:
+                loser, loser_seq = hedge.thread, hedge.seq
+            # The loser may have moved on to another segment since; that
+            # download is left alone
+            if loser is not None and loser.current == (order, loser_seq):
+                loser.abort()
+            return True
+        finally:
+            self._lock.release()
+
+    def _add_latency(self, latency):
+        self._lock.acquire()
+        self._latencies.append(latency)
+        self._lock.release()
+
+    def get_hedge_threshold(self):
+        """
+        Returns how long, in seconds, a segment may be downloading before it's
+        hedged, or ``None`` until enough downloads have been timed.
+        """
+        self._lock.acquire()
+        try:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        finally:
+            self._lock.release()
+        return latencies[min(len(latencies)-1, len(latencies)*HEDGE_PERCENTILE//100)]
+
+    def hedge(self, order):
+        """
+        Issues a duplicate request for segment ``order`` if it has been
+        downloading for longer than the hedge threshold.  The hedge goes ahead
+        of everything else, so it's picked up by the next connection that's
+        free.  Returns True if a hedge was issued.
+        """
+        threshold = self.get_hedge_threshold()
+        if threshold is None or self.threads < 2:
+            return False
+
+        self._lock.acquire()
+        try:
+            if order not in self._started or order in self._hedges:
+                return False
+            started, msgid, thread = self._started[order]
+            if time.time()-started < threshold:
+                return False
+
+            seq = next(self._sequence)
+            self._hedges[order] = Hedge(order, self._inflight[order], seq)
+            self.hedged += 1
+        finally:
+            self._lock.release()
+
+        log.debug("Hedging segment %s after %.2fs" % (order, time.time()-started))
+        self._msg_ids.put((HEDGE_PRIORITY, seq, order, msgid))
+        return True
+
+    def get_hedge_rate(self):
+        """
+        Returns the fraction of downloaded segments that were hedged.
+        """
+        if not self.downloaded:
+            return 0
+        return self.hedged/float(self.downloaded)
+
+    def cancel(self, order):
+        """
+        Cancels a segment queued with ``add_segment``.  If it has already been
+        downloaded it is discarded, if it is still queued it will be skipped and
+        if it is being downloaded the result will be dropped.
+        """
+        self._lock.acquire()
+        try:
+            self._articles.pop(order, None)
+            self._pending.pop(order, None)
+            self._started.pop(order, None)
+            seq = self._inflight.pop(order, None)
+            if seq is not None:
+                self._dropped.add(seq)
+            hedge = self._hedges.pop(order, None)
+            if hedge is not None:
+                self._dropped.add(hedge.seq)
+        finally:
+            self._lock.release()
+
+    def set_priority(self, order, priority):
+        """
+        Moves a queued segment to ``priority``.  Returns ``False`` if the
+        segment isn't waiting in the queue.
+        """
+        # Queued again under the lock, so no thread can start the old entry
+        # in between; the new sequence makes it skip the old one instead.
+        self._lock.acquire()
+        try:
+            entry = self._pending.get(order)
+            if entry is None:
+                return False
+            self._queue(priority, order, entry[1])
+            return True
+        finally:
+            self._lock.release()
 
     def set_throttle(self, bps):
         """
-        Throttle download speed, in bits per second.
+        Throttle download speed, in bits per second.  0 turns the throttle
+        off.
         """
         self._throttle = bps/8.0 # Stored as Bytes/sec
+        if not bps:
+            self._delay = 0
 
     def add_bytes(self, bytes):
         self._lock.acquire()
         now = time.time()
         dt  = now-self._timer
         if dt >= TIME_SEP:
-            speed   = self.get_speed()          # Speed in Bytes/sec
-            dt      = now-self._start_time
+            # Here is the throttling code.  The delay every thread sleeps before
+            # an article is adjusted by how far ahead of (or behind) the
+            # throttle the last interval was.  Only the last interval counts,
+            # since the throttle changes as the stream's buffer fills up.
+            if self._throttle > 0:
+                ahead       = self._bytes/self._throttle - dt
+                self._delay = max(0, self._delay + ahead/self.threads)
+                log.debug("Setting delay to: %f" % self._delay)
 
             self._total_bytes += self._bytes
             self._bytes        = 0
             self._timer        = now
 
-            # Here is the throttling code.  It is pretty dirty, but works more or less.
-            if self._throttle > 0:
-                if speed > self._throttle:
-                    # set the delay in an attempt to throttle
-                    self._delay = self._total_bytes/self._throttle - dt
-                    if self._delay < 0:
-                        self._delay = 0
-                    self._delay /= self.threads
-                    log.debug("Setting delay to: %f" % self._delay)
-                else:
-                    self._delay = 0
-
         self._bytes += bytes
         self._lock.release()
 
     def get_segment(self, order, remove=True, timeout=10):
+        """
+        Returns the segment queued under ``order`` once it has been downloaded,
+        or ``None`` after ``timeout`` seconds.  Someone is waiting for the
+        segment, so it's hedged if it's taking too long.
+        """
         start = time.time()
-        while time.time()-start < timeout:
+        while True:
             if self._articles.has_key(order):
                 if remove:
                     return self._articles.pop(order)[0]
                 return self._articles[order][0]
+            if time.time()-start >= timeout:
+                return None
+            self.hedge(order)
+            time.sleep(0.1)
+
+    def get_segments(self, orders, timeout=10, hedge=None):
+        """
+        Returns ``(order, data)`` for every downloaded segment whose order is
+        in ``orders``, removing them, as soon as there's at least one.  Returns
+        an empty list after ``timeout`` seconds.  ``hedge`` is the segment the
+        caller needs first; it's hedged if it's taking too long.
+        """
+        start = time.time()
+        while True:
+            ready = [(order, self._articles.pop(order)[0]) for order in self._articles.keys()
+                     if order in orders]
+            if ready or time.time()-start >= timeout:
+                return ready
+            if hedge is not None:
+                self.hedge(hedge)
             time.sleep(0.1)
 
     def get_speed(self, pretty=False):
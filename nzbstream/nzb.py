@@ -0,0 +1,209 @@
+"""
+Incremental NZB parsing.
+
+``pynzb`` needs the whole document before it hands anything back, which for a
+multi-megabyte NZB fetched over HTTP means no NNTP work can start until the
+download and the parse have both finished.  The parser here is built on
+``iterparse`` and yields every file as soon as its ``<file>`` element has been
+read, so callers can start issuing requests while the rest is still loading.
+
+Segments are not kept as objects at all.  For NZBs with hundreds of thousands
+of segments that would be hundreds of MB of Python objects, so every segment
+is instead a row in a ``SegmentTable``: ``array`` backed columns for the sizes,
+numbers and file indices plus a single packed blob of message ids.  Files refer
+to their segments by index into the table.
+"""
+
+import hashlib
+import logging
+import urllib
+import zlib
+
+from array import array
+from itertools import islice
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+log = logging.getLogger('nzbstream.nzb')
+
+GZIP_MAGIC = '\x1f\x8b'
+READ_SIZE  = 16 * 1024 # 16 KB, in bytes
+
+class SegmentTable(object):
+    """
+    Compact storage for every segment of an NZB.  A segment is identified by
+    its index in the table; segments of the same file are stored contiguously
+    and in order of their segment number.
+    """
+    def __init__(self):
+        self.sizes      = array('I')        # Encoded size of the article, in bytes
+        self.numbers    = array('I')        # Segment number within its file
+        self.files      = array('I')        # Index of the file in the NZB
+        self._ids       = array('c')        # Packed message ids
+        self._offsets   = array('I', [0])   # Offset of each message id in _ids
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, file_index, number, size, message_id):
+        self.sizes.append(size)
+        self.numbers.append(number)
+        self.files.append(file_index)
+        self._ids.fromstring(message_id)
+        self._offsets.append(len(self._ids))
+        return len(self.sizes)-1
+
+    def message_id(self, index):
+        return self._ids[self._offsets[index]:self._offsets[index+1]].tostring()
+
+    def size(self, index):
+        return self.sizes[index]
+
+    def number(self, index):
+        return self.numbers[index]
+
+class NZBFile(object):
+    """
+    A file in an NZB.  ``segments`` holds the indices of the file's segments in
+    the ``SegmentTable``, in order.
+    """
+    def __init__(self, table, start, count, poster=None, date=None, subject=None):
+        self.table    = table
+        self.start    = start
+        self.count    = count
+        self.poster   = poster
+        self.date     = date
+        self.subject  = subject
+        self.filename = subject
+        self.groups   = []
+
+    def __repr__(self):
+        return "<NZBFile: %s>" % self.filename
+
+    def get_segments(self):
+        return xrange(self.start, self.start+self.count)
+    segments = property(get_segments)
+
+    def first_segments(self, count):
+        """
+        Returns the indices of the first ``count`` segments of this file.
+        """
+        return list(islice(self.segments, count))
+
+    def get_size(self):
+        return sum(islice(self.table.sizes, self.start, self.start+self.count))
+    size = property(get_size)
+
+class NZBReader(object):
+    """
+    File-like wrapper around an NZB stream.  A few bytes are read up front to
+    sniff the gzip magic; compressed streams are inflated as they're read.  The
+    SHA-1 of the (uncompressed) content is computed along the way.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._buf    = fileobj.read(len(GZIP_MAGIC))
+        self._zlib   = None
+        self._eof    = False
+        self._sha1   = hashlib.sha1()
+
+        if self._buf == GZIP_MAGIC:
+            log.debug("NZB is gzip compressed")
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._buf  = self._zlib.decompress(self._buf)
+        self._sha1.update(self._buf)
+
+    def is_compressed(self):
+        return self._zlib is not None
+    compressed = property(is_compressed)
+
+    def hexdigest(self):
+        """
+        Returns the SHA-1 of the content read so far.
+        """
+        return self._sha1.hexdigest()
+
+    def _fill(self):
+        data = self.fileobj.read(READ_SIZE)
+        if not data:
+            self._eof = True
+            if self._zlib:
+                data = self._zlib.flush()
+                self._sha1.update(data)
+                self._buf += data
+            return
+        if self._zlib:
+            data = self._zlib.decompress(data)
+        self._sha1.update(data)
+        self._buf += data
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            self._fill()
+
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+def open_nzb(path):
+    """
+    Opens a local or remote NZB, which may be gzip compressed.
+    """
+    return NZBReader(urllib.urlopen(path))
+
+def _tag(elem):
+    # Strip the namespace, if any
+    return elem.tag.rsplit('}', 1)[-1]
+
+def iterparse(fileobj, table):
+    """
+    Yields an ``NZBFile`` for every file in the NZB as soon as it has been
+    read, adding its segments to ``table``.  Parsed elements are thrown away as
+    we go so memory use doesn't grow with the size of the NZB.
+    """
+    root  = None
+    index = 0
+    for event, elem in ElementTree.iterparse(fileobj, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+
+        if _tag(elem) != 'file':
+            continue
+
+        attrib   = dict(elem.attrib)
+        groups   = []
+        segments = []
+        for child in elem.getiterator():
+            tag = _tag(child)
+            if tag == 'group':
+                groups.append(child.text)
+            elif tag == 'segment':
+                segments.append((int(child.get('number', 0)),
+                                 int(child.get('bytes', 0)),
+                                 (child.text or '').strip()))
+        segments.sort()
+
+        elem.clear()
+        if root is not None:
+            root.clear()
+
+        if not segments:
+            log.debug("Skipping file without segments: %s" % attrib.get('subject'))
+            continue
+
+        f = NZBFile(table, len(table), len(segments),
+                    attrib.get('poster'), attrib.get('date'), attrib.get('subject'))
+        f.groups = groups
+        for number, size, message_id in segments:
+            table.add(index, number, size, message_id)
+        index += 1
+        yield f
@@ -0,0 +1,163 @@
+"""
+Streaming the extracted file into a pipe instead of onto disk.
+
+When the extracted file is handed straight to a player or transcoder there's
+no reason to keep a copy on disk.  ``PipeOutput`` takes the place of the file
+``RarFile`` would otherwise open: writes are copied into a fixed-size
+``RingBuffer`` and a background thread drains the buffer into stdout or a
+named pipe.  A full buffer blocks the writer, which in turn stops the stream
+from consuming (and so downloading) further segments, so memory use stays
+constant however large the extracted file is.
+"""
+
+import logging
+import sys
+import threading
+
+log = logging.getLogger('nzbstream.pipe')
+
+DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024 # 16 MB, in bytes
+CHUNK_SIZE          = 256 * 1024       # 256 KB, in bytes
+
+class RingBuffer(object):
+    """
+    Bounded FIFO of bytes, backed by a single preallocated ``bytearray``.
+    ``write`` blocks while the buffer is full and ``read`` while it's empty.
+    """
+    def __init__(self, size=DEFAULT_BUFFER_SIZE):
+        self.size       = size
+        self._buf       = bytearray(size)
+        self._start     = 0     # Offset of the first unread byte
+        self._len       = 0     # Number of unread bytes
+        self._closed    = False
+        self._cond      = threading.Condition()
+
+    def __len__(self):
+        return self._len
+
+    def write(self, data):
+        view = memoryview(data)
+        pos  = 0
+        with self._cond:
+            while pos < len(view):
+                while self._len == self.size and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    raise IOError("Write to closed ring buffer")
+
+                # Copy as much as fits before the end of the backing array
+                end = (self._start+self._len) % self.size
+                cnt = min(len(view)-pos, self.size-self._len, self.size-end)
+                self._buf[end:end+cnt] = view[pos:pos+cnt]
+                self._len += cnt
+                pos       += cnt
+                self._cond.notify_all()
+        return pos
+
+    def read(self, size):
+        """
+        Returns up to ``size`` bytes, or an empty string once the buffer has
+        been closed and drained.
+        """
+        with self._cond:
+            while self._len == 0 and not self._closed:
+                self._cond.wait()
+            if self._len == 0:
+                return ''
+
+            cnt  = min(size, self._len, self.size-self._start)
+            data = str(self._buf[self._start:self._start+cnt])
+            self._start  = (self._start+cnt) % self.size
+            self._len   -= cnt
+            self._cond.notify_all()
+            return data
+
+    def close(self):
+        """
+        No more data will be written; readers get what's left.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def abort(self):
+        """
+        Closes the buffer and throws away what's left, e.g. when the reader
+        has gone away.
+        """
+        with self._cond:
+            self._closed = True
+            self._len    = 0
+            self._cond.notify_all()
+
+class PipeOutput(object):
+    """
+    Write-only file-like object draining into ``target``, a path (usually a
+    named pipe) or an open file object.  Paths are opened from the drain
+    thread since opening a pipe blocks until the other end is opened.
+    """
+    def __init__(self, target, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.target = target
+        self.name   = getattr(target, 'name', target)
+        self.buffer = RingBuffer(buffer_size)
+        self.error  = None
+
+        self._fd     = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._drain, name="Pipe")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _drain(self):
+        try:
+            if isinstance(self.target, basestring):
+                log.debug("Opening %s" % self.target)
+                self._fd = open(self.target, 'wb')
+            else:
+                self._fd = self.target
+
+            while True:
+                data = self.buffer.read(CHUNK_SIZE)
+                if not data:
+                    break
+                self._fd.write(data)
+                self._fd.flush()
+        except (IOError, OSError), e:
+            # Most likely the player went away
+            log.error("Could not write to %s: %s" % (self.name, e))
+            self.error = e
+            self.buffer.abort()
+
+    def write(self, data):
+        if self.error:
+            raise IOError("Pipe closed: %s" % self.error)
+        self.buffer.write(data)
+
+    def flush(self):
+        # The drain thread writes continuously
+        pass
+
+    def close(self):
+        """
+        Waits for the buffered data to be written and closes the target, unless
+        it was given as a file object.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.buffer.close()
+        self._thread.join()
+        if self._fd and isinstance(self.target, basestring):
+            self._fd.close()
+
+    def is_closed(self):
+        return self._closed
+    closed = property(is_closed)
+
+def open_pipe(path, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Returns a ``PipeOutput`` for ``path``; ``-`` means stdout.
+    """
+    if path == '-':
+        return PipeOutput(sys.stdout, buffer_size)
+    return PipeOutput(path, buffer_size)
@@ -0,0 +1,110 @@
+"""
+Streaming of posts that aren't rar archives.
+
+Plenty of posts carry the media file itself, either whole or cut into plain
+split parts (``movie.mkv.001``, ``movie.mkv.002``, ...) that only have to be
+concatenated.  There are no headers to parse: the extracted file is simply
+the decoded segments of the parts, in order.
+
+``PlainSet`` stands in for a ``rarset.RarSet`` so that the ``Manager`` streams
+these posts the same way, with the same scheduler, throttle and seek index.
+Its single file is a ``RarFile`` made from a stored "header" covering the
+whole file, so in-order and planned writes work as they do for rars.
+"""
+
+import collections
+import logging
+import re
+
+from nzbstream import rarspec, writer
+from nzbstream.rarfile import RarFile, is_media
+
+log = logging.getLogger('nzbstream.plain')
+
+SPLIT_RE = re.compile(r'^(.+)\.(\d{3})$')  # name.ext.001 and on
+
+def find_sets(nzb, heads):
+    """
+    Returns ``(name, parts, [name])`` for every media file in ``nzb`` that
+    can be streamed without an archive, largest first: whole media files and
+    complete split sets of one.  ``heads`` maps the index of every file in
+    ``nzb`` to its first segment; files starting with a rar marker are left
+    to ``rarset``.  The format matches that of ``rarset.group_rarsets``.
+    """
+    splits  = collections.defaultdict(dict)
+    sets    = []
+    for i, f in enumerate(nzb):
+        if rarspec.is_rar_data(heads[i]):
+            continue
+        match = SPLIT_RE.match(f.filename)
+        if match:
+            splits[match.group(1)][int(match.group(2))] = f
+        elif is_media(f.filename):
+            sets.append((f.filename, [f], [f.filename]))
+
+    for name, parts in splits.items():
+        if not is_media(name):
+            continue
+        # Numbering starts at .001, or .000 for some splitters
+        first   = min(parts)
+        numbers = sorted(parts)
+        if first > 1 or numbers != range(first, first+len(numbers)):
+            log.debug("Incomplete split set %s: %s" % (name, numbers))
+            continue
+        sets.append((name, [parts[n] for n in numbers], [name]))
+
+    return sorted(sets, key=lambda s: -sum(f.size for f in s[1]))
+
+class PlainSet(object):
+    """
+    The parts of a media file that isn't archived, in order, ``size`` bytes
+    in total once decoded.  Has the attributes and methods of ``RarSet`` the
+    ``Manager`` uses; the parts are its ``rarchives``.
+    """
+    def __init__(self, name, parts, size, output=None, fsync=writer.DEFAULT_FSYNC, use_mmap=False):
+        self.name           = name
+        self.rarchives      = list(parts)   # The parts, in order
+        self.files          = collections.OrderedDict()
+        self.skipped        = set()
+        self.current_file   = None
+
+        # The whole file as a single stored member
+        header = rarspec.RarInfo()
+        header.type          = rarspec.RAR_BLOCK_FILE
+        header.filename      = name
+        header.file_size     = size
+        header.add_size      = size
+        header.compress_type = rarspec.RAR_M0
+        header.flags         = 0
+        header.header_crc    = 0
+        header.salt          = None
+        self.files[name] = RarFile(header, output, fsync, use_mmap)
+        self.current_file = self.files[name]
+        self.main_file    = self.current_file
+
+    def __repr__(self):
+        return "<PlainSet: %s>" % self.name
+
+    def __str__(self):
+        return self.name
+
+    def wants(self, filename):
+        return True
+
+    def get_progress(self):
+        return [(name, f.get_progress()) for name, f in self.files.items()]
+
+    def is_complete(self):
+        return all(f.complete for f in self.files.values())
+
+    def skip(self, size):
+        # Every segment is wanted; see rarset.MemberPlan
+        raise ValueError("Nothing to skip in %s" % self.name)
+
+    def read(self, data):
+        if not self.current_file:
+            return
+        self.current_file.write(data)
+        if self.current_file.complete:
+            log.debug("File is complete")
+            self.current_file = None
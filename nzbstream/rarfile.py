@@ -1,5 +1,8 @@
 import logging
 import os
+import zlib
+
+from nzbstream import rarspec, writer
 
 try:
     from pymediainfo import MediaInfo
@@ -10,29 +13,62 @@ import pdb
 
 log = logging.getLogger('nzbstream.rarfile')
 
+def is_media(filename):
+    return filename.rsplit('.', 1)[-1].lower() in RarFile.EXTENSIONS
+
+def get_path(filename):
+    """
+    Returns the path, relative to the current directory, ``filename`` is
+    extracted to.  Members can sit in directories of the archive; those are
+    created, but nothing is written outside the current directory.
+    """
+    # RAR3 archives keep the '\\' path separator
+    parts = [part for part in filename.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    path  = os.path.join(*parts) if parts else 'unnamed'
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return path
+
 class RarFile(object):
     EXTENSIONS = ['mkv', 'avi', 'mpeg', 'mpg', 'mp4']
 
-    def __init__(self, header):
-        # Create the file
+    def __init__(self, header, output=None, fsync=writer.DEFAULT_FSYNC, use_mmap=False,
+                 password=None, keys=None):
+        # Create the file, unless we were given somewhere else to write to
         self.filename   = header.filename
-        self.path       = header.filename   # TODO: Support output directory
+        self.path       = get_path(header.filename) if output is None else None # TODO: Support output directory
         self.file_size  = header.file_size
         self.duration   = 0
         self.complete   = False
         self.realname   = None
+        self.compressed = header.compress_type != rarspec.RAR_M0 # Has to go through extract.Extractor
+        self.encrypted  = bool(header.flags & rarspec.RAR_FILE_PASSWORD)
+        self.password   = password
 
         self._header    = header                # Current header
         self._headers   = []                    # All headers seen so far
-        self._fd        = open(self.path, 'wb') # The actual file on disk
+        self._fd        = output    # The actual file on disk, or a pipe.PipeOutput
+        if output is None and use_mmap:
+            self._fd    = writer.MappedOutput(self.path, self.file_size, fsync)
+        elif output is None:
+            self._fd    = writer.WriteBehind(self.path, fsync, self.file_size)
 
         # Number of bytes written for the current header.  Once this value reaches
         # header.add_size, we must be given the next header before attempting to
         # write more data.
         self._written       = 0                     
         self._total_written = 0
+        self._header_offset = 0 # Offset in the file of the current header's data
+        self._keys          = keys if keys is not None else {} # (password, salt) -> (key, iv)
+        self._decrypt       = None  # rarspec.PayloadDecrypt for the current header
+        self._crc           = 0     # CRC32 of the decrypted data
 
         self.add_header(header)
+        if not self.file_size:
+            # There's nothing to write
+            log.debug("%s is empty" % self.filename)
+            self.complete = True
+            self.close()
 
     def add_header(self, header):
         if header.filename != self.filename:
@@ -48,32 +84,91 @@ class RarFile(object):
         self._header    = header
         self._written   = 0
 
+        # The data of every header follows that of the previous headers
+        self._header_offset = sum(hdr.add_size for hdr in self._headers[:-1])
+
+        # Every volume's part is encrypted on its own, starting over with the
+        # same key and IV
+        if self.encrypted and self.password is not None and header.salt and rarspec._have_crypto:
+            self._decrypt = rarspec.PayloadDecrypt(*self._get_key(header.salt))
+
+    def _get_key(self, salt):
+        """
+        Returns the ``(key, iv)`` for ``salt``.  Deriving it takes a while, so
+        it's kept for the next volume and the other members sharing ``keys``.
+        """
+        if (self.password, salt) not in self._keys:
+            self._keys[(self.password, salt)] = rarspec.rar3_s2k(self.password, salt)
+        return self._keys[(self.password, salt)]
+
+    def _check_crc(self):
+        """
+        Checks the decrypted file against the CRC in the last header.  A
+        wrong password doesn't fail to decrypt, it just gives garbage.
+        """
+        if self._crc & 0xffffffff != self._header.CRC:
+            log.error("CRC error in %s; wrong password?" % self.filename)
+
+    def is_decrypting(self):
+        return self._decrypt is not None
+    decrypting = property(is_decrypting)
+
     def get_progress(self):
+        if not self.file_size:
+            return 1.0
         return self._total_written/float(self.file_size)
 
+    def get_remaining(self):
+        """
+        Returns the number of bytes still to be written for the current header.
+        """
+        if not self._header or self.complete:
+            return 0
+        return self._header.add_size-self._written
+
     def write(self, data):
+        """
+        Writes as much of ``data``, a string or memoryview, as belongs to the
+        current header.  Returns the number of bytes written.
+        """
         if not self._fd or not self._header or self.complete:
             return
+        if self.encrypted and not self._decrypt:
+            return 0
 
-        pos = data.tell()
-        data.seek(0, os.SEEK_END)
-        total_bytes = data.tell()-pos
-        data.seek(pos)
-
+        total_bytes     = len(data)
         bytes_to_write  = self._header.add_size-self._written
-        pos             = self._fd.tell()
+        if total_bytes > bytes_to_write:
+            data = data[:bytes_to_write]
+        bytes_written   = len(data)
 
-        self._fd.write(data.read(bytes_to_write))
+        if self._decrypt:
+            # Encrypted data is padded to the cipher block size at the end of
+            # the file, so there's more of it than there is of the file.  It
+            # can only be decrypted in order.
+            offset = self._total_written
+            data   = self._decrypt.decrypt(data)[:self.file_size-self._total_written]
+            self._crc = zlib.crc32(data, self._crc)
+        else:
+            offset = self._header_offset+self._written
+
+        if hasattr(self._fd, 'write_at'):
+            self._fd.write_at(offset, data)
+        else:
+            self._fd.write(data)
+        self._fd.flush() # Readers of the extracted file need to see this data
 
-        bytes_written        = self._fd.tell()-pos
         self._written       += bytes_written
-        self._total_written += bytes_written
+        self._total_written += len(data)
         
         log.debug("Wrote %d bytes of %d bytes" % (bytes_written, total_bytes))
         if self._written == self._header.add_size:
             if self._total_written == self.file_size:
                 log.debug("File complete!")
                 self.complete = True
+                if self._decrypt:
+                    self._check_crc()
+                self.close()
             else:
                 log.debug("Waiting for next rarchive")
             
@@ -84,10 +179,63 @@ class RarFile(object):
 
         return bytes_written
 
+    def write_at(self, offset, data):
+        """
+        Writes ``data`` at ``offset`` of the extracted file, regardless of the
+        current header.  Used for segments placed by a ``rarset.LayoutPlan``,
+        which may arrive in any order, and for decompressed data.  Outputs
+        without ``write_at``, such as pipes, only take data in order.  Returns
+        the number of bytes written.
+        """
+        if not self._fd or self.complete:
+            return 0
+
+        if hasattr(self._fd, 'write_at'):
+            self._fd.write_at(offset, data)
+        else:
+            self._fd.write(data)
+        self._total_written += len(data)
+        if self._total_written == self.file_size:
+            log.debug("File complete!")
+            self.complete = True
+            self.close()
+        return len(data)
+
     def tell(self):
-        if not self._fd:
+        return self._total_written
+
+    def get_written(self, offset=0):
+        """
+        Returns the number of bytes from ``offset`` on that can be read back
+        from ``path``; writes may still be queued for the rest.
+        """
+        if not self.path:
             return 0
-        return self._fd.tell()
+        if hasattr(self._fd, 'get_written'):
+            return self._fd.get_written(offset)
+        return max(0, self._total_written-offset)
+
+    def view(self, offset, size):
+        """
+        Returns up to ``size`` written bytes from ``offset`` without copying
+        them, or ``None`` if the output doesn't support it or the byte at
+        ``offset`` hasn't been written.
+        """
+        if not hasattr(self._fd, 'view'):
+            return None
+        return self._fd.view(offset, size)
+
+    def get_available(self):
+        return self.get_written(0)
+    available = property(get_available)
+
+    def get_disk_time(self):
+        return getattr(self._fd, 'disk_time', 0)
+    disk_time = property(get_disk_time)
+
+    def get_stall_time(self):
+        return getattr(self._fd, 'stall_time', 0)
+    stall_time = property(get_stall_time)
 
     def close(self):
         if not self._fd:
@@ -99,14 +247,13 @@ class RarFile(object):
     closed = property(is_closed)
 
     def is_media(self):
-        ext = self.filename.rsplit('.', 1)[-1]
-        if ext.lower() not in self.EXTENSIONS:
+        if not is_media(self.filename):
             log.debug("File is not a media file")
             return False
         return True
 
     def get_duration(self):
-        if MediaInfo is not None:
+        if MediaInfo is not None and self.path:
             for track in MediaInfo.parse(self.path).tracks:
                 if track.track_type == 'Video':
                     log.debug("Found video track with duration %d" % track.duration)
@@ -1,6 +1,10 @@
+import bisect
+import collections
+import fnmatch
 import logging
 import rarspec
 import re
+import struct
 import time
 
 try:
@@ -8,12 +12,14 @@ try:
 except:
     from StringIO import StringIO
 
-from rarfile import RarFile
+from rarfile import RarFile, is_media
+from nzbstream import writer
 
 import pdb
 
 RAR_FIRST_RE = re.compile(r"(\.001|\.part0*1\.rar|^((?!part\d*\.rar$).)*\.rar)$")
 RAR_RE       = re.compile(r'\.(rar|r\d\d|[\d]+)$')
+VOLUME_RE    = re.compile(r'(\.part\d+\.rar|\.rar|\.[rs]\d\d|\.\d+)$', re.I) # Volume suffix of a rarchive
 
 log = logging.getLogger('nzbstream.rarset')
 
@@ -32,6 +38,588 @@ RAR_HEADER_NAMES = {
 
 NUM_RE = re.compile('([0-9]+)')
 
+# Largest tail we scan for the end of archive block.  The block itself is at
+# most 20 bytes, but some archivers pad the end of a volume.
+ENDARC_SCAN_LENGTH = 64
+
+# Bytes needed to tell the size of a block header: the RAR 1.5-4.x base block
+# header, or the crc and size vint of a RAR5 header.  Both signatures are
+# told apart by then as well.
+BASE_HEADER_SIZE = 7
+
+# Events returned by BlockParser.feed
+EVENT_HEADER = 'header'
+EVENT_DATA   = 'data'
+
+def guess_first_rarchive(nzb):
+    """
+    Returns the file most likely to be the first rarchive going by filenames
+    alone, or ``None`` if there's no good guess.
+    """
+    firsts = [f for f in nzb if RAR_FIRST_RE.search(f.filename)]
+    if len(firsts) == 1:
+        return firsts[0]
+
+    try:
+        return RarSet(nzb).rarchives[0]
+    except Exception, e:
+        log.debug("Could not guess first rarchive: %s" % e)
+        return None
+
+def get_stem(filename):
+    """
+    Returns ``filename`` without its volume suffix: the name every rarchive of
+    a rarset has in common.
+    """
+    return VOLUME_RE.sub('', filename)
+
+def group_rarsets(nzb, volumes=()):
+    """
+    Splits the rarchives of ``nzb`` into rarsets, for NZBs holding more than
+    one, such as season packs with a rarset per episode.  Rarchives are
+    grouped by name without the volume suffix and, through the headers of
+    ``volumes``, by the files split across them: volumes holding parts of the
+    same file (same name and size) are of the same rarset whatever they're
+    called.  Files whose headers show they aren't rarchives are left out.
+
+    Returns ``(name, files, members)`` for every rarset, sorted by name, with
+    the files in NZB order and the names of the files in the rarset found in
+    the headers so far.
+    """
+    volumes = dict((id(v.file), v) for v in volumes)
+    parent  = {}
+
+    def find(key):
+        while parent.setdefault(key, key) != key:
+            key = parent[key]
+        return key
+
+    def union(a, b):
+        parent[find(a)] = find(b)
+
+    rarchives = []
+    for f in nzb:
+        volume = volumes.get(id(f))
+        if volume is not None and not volume.is_rar:
+            continue
+        if volume is None and not RAR_RE.search(f.filename):
+            continue
+        rarchives.append(f)
+
+        union(('file', id(f)), ('stem', get_stem(f.filename)))
+        for header in volume.headers if volume else []:
+            if header.type == rarspec.RAR_BLOCK_FILE and header.flags & (
+                    rarspec.RAR_FILE_SPLIT_BEFORE | rarspec.RAR_FILE_SPLIT_AFTER):
+                union(('file', id(f)), ('member', header.filename, header.file_size))
+
+    groups = collections.OrderedDict()
+    for f in rarchives:
+        groups.setdefault(find(('file', id(f))), []).append(f)
+
+    # A file whose header isn't in the first segment of the volume it starts
+    # in can't be followed, which leaves the volumes after it without a first
+    # volume.  Those go with the rarset posted nearest to them.
+    position = dict((id(f), i) for i, f in enumerate(nzb))
+    headed   = []
+    headless = []
+    for files in groups.values():
+        if any(id(f) in volumes and volumes[id(f)].first_volume for f in files):
+            headed.append(files)
+        elif all(id(f) in volumes for f in files):
+            headless.append(files)
+        else:
+            headed.append(files)
+    for files in headless:
+        if not headed:
+            headed.append(files)
+            continue
+        start = min(position[id(f)] for f in files)
+        nearest = min(headed, key=lambda other: min(abs(position[id(f)]-start) for f in other))
+        log.debug("Adding %d volumes without a first volume to %s" % (len(files), nearest[0].filename))
+        nearest.extend(files)
+        nearest.sort(key=lambda f: position[id(f)])
+
+    rarsets = []
+    for files in headed:
+        members = []
+        for f in files:
+            for filename, offset, size, compressed in volumes[id(f)].get_members() if id(f) in volumes else []:
+                if filename not in members:
+                    members.append(filename)
+
+        # Named after the stem most of its rarchives share or, when they
+        # don't share one (obfuscated names), after the first file in it
+        stems = collections.defaultdict(int)
+        for f in files:
+            stems[get_stem(f.filename)] += 1
+        name, count = sorted(stems.items(), key=lambda item: (-item[1], item[0]))[0]
+        if count == 1 and len(files) > 1 and members:
+            name = members[0].replace('\\', '/').rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        rarsets.append((name, files, members))
+    return sorted(rarsets, key=lambda rarset: rarset[0])
+
+class RarVolume(object):
+    """
+    Header information for a single rarchive, read from the first and last
+    segments of the file rather than derived from its (possibly obfuscated)
+    name.
+
+    The first segment holds the main header, whose ``RAR_MAIN_FIRSTVOLUME``
+    flag identifies the first volume of the set.  The last segment holds the
+    end of archive block, which stores the volume number when the archiver
+    sets ``RAR_ENDARC_VOLNR``.  RAR5 volumes store their number in the main
+    header, so there the first segment is enough.
+    """
+    def __init__(self, file, head, tail=None):
+        self.file           = file  # NZB file for this rarchive
+        self.part_size      = len(head) # Decoded size of every segment but the last
+        self.is_rar         = rarspec.is_rar_data(head)
+        self.rar5           = head.startswith(rarspec.RAR5_ID)
+        self.first_volume   = False # True if this is the first volume
+        self.volume_number  = None  # Volume number, starting from 0
+        self.main           = None  # Main archive header
+        self.headers        = []    # Headers found in the first segment
+        self.complete       = False # True if headers has every file in the volume
+
+        self._rs = rarspec.RarSpec("", partial_ok=True, stream=True, parse=False)
+
+        if self.is_rar:
+            self._parse_head(head)
+            if tail is not None:
+                self.add_tail(tail)
+
+    def __repr__(self):
+        return "<RarVolume: %s (%s)>" % (self.file.filename, self.volume_number)
+
+    def add_tail(self, tail):
+        """
+        Reads the volume number from ``tail``, the last segment, for volumes
+        that don't have it in the first, and the headers following the files
+        found in the first segment when they're in the last.
+        """
+        if not self.is_rar:
+            return
+        if not self.rar5:
+            self._parse_tail(tail)
+        if not self.complete:
+            self._parse_rest(tail)
+
+    def get_payload(self):
+        """
+        Returns ``(file_offset, add_size, filename)`` of the first file stored in
+        this volume, or ``None`` if no file header was found in the first
+        segment.  Compressed payload doesn't map onto the extracted file, so
+        there's none for compressed files either, nor for encrypted files,
+        which can only be decrypted in order.
+        """
+        for header in self.headers:
+            if header.type == rarspec.RAR_BLOCK_FILE:
+                if header.compress_type != rarspec.RAR_M0:
+                    return None
+                if header.flags & rarspec.RAR_FILE_PASSWORD:
+                    return None
+                return header.file_offset, header.add_size, header.filename
+        return None
+
+    def get_members(self):
+        """
+        Returns ``(filename, file_offset, add_size, compressed)`` of every file
+        whose header is in the first segment, in order.  Unless ``complete`` is
+        set, more files may follow them in the volume.
+        """
+        return [(h.filename, h.file_offset, h.add_size, h.compress_type != rarspec.RAR_M0)
+                for h in self.headers if h.type == rarspec.RAR_BLOCK_FILE and not h.isdir()]
+
+    def _parse_headers(self, buf, base=0):
+        """
+        Adds the headers in ``buf``, which starts at offset ``base`` of the
+        volume, until the data runs out or the last file of the volume.
+        """
+        while True:
+            try:
+                header = self._rs._parse_header(buf)
+            except rarspec.Error, e:
+                log.error("Could not parse headers of %s: %s" % (self.file.filename, e))
+                break
+            if not header:
+                break
+            header.file_offset += base
+            self.headers.append(header)
+            if header.type == rarspec.RAR_BLOCK_MAIN:
+                self.main = header
+            elif header.type == rarspec.RAR_BLOCK_ENDARC:
+                self.complete = True
+                break
+            elif header.type == rarspec.RAR_BLOCK_FILE and header.flags & rarspec.RAR_FILE_SPLIT_AFTER:
+                # The file runs to the end of the volume
+                self.complete = True
+                break
+            if header.add_size > 0:
+                buf.seek(header.file_offset - base + header.add_size)
+
+    def _parse_head(self, data):
+        # The signature is parsed as a marker block, which also tells the
+        # parser which format follows
+        self._parse_headers(StringIO(data))
+
+        if not self.main:
+            return
+
+        if not self.main.flags & rarspec.RAR_MAIN_VOLUME:
+            # Not a multi-volume archive
+            self.first_volume = True
+        elif self.main.flags & rarspec.RAR_MAIN_NEWNUMBERING:
+            self.first_volume = bool(self.main.flags & rarspec.RAR_MAIN_FIRSTVOLUME)
+        else:
+            # RAR 2.x does not set RAR_MAIN_FIRSTVOLUME, so fall back to
+            # checking whether the first file continues from a previous volume
+            for header in self.headers:
+                if header.type == rarspec.RAR_BLOCK_FILE:
+                    self.first_volume = not header.flags & rarspec.RAR_FILE_SPLIT_BEFORE
+                    break
+
+        if self.rar5:
+            # RAR5 stores the volume number in the main header
+            self.volume_number = self.main.volume_number
+        elif self.first_volume:
+            self.volume_number = 0
+
+    def _parse_rest(self, data):
+        # The last volume usually ends with a file that isn't split, so the
+        # end of archive block, and any file after it, is only in the last
+        # segment.  The headers can be read from there when the payload of
+        # the last header found so far ends in it too.
+        count = len(self.file.segments)
+        if not self.headers or count < 2:
+            return
+        last  = self.headers[-1]
+        start = self.part_size*(count-1)    # Offset of the last segment
+        end   = last.file_offset + last.add_size
+        if not start <= end <= start+len(data):
+            log.debug("Headers of %s not in its last segment" % self.file.filename)
+            return
+        buf = StringIO(data)
+        buf.seek(end-start)
+        self._parse_headers(buf, start)
+
+    def _parse_tail(self, data):
+        start = max(0, len(data)-ENDARC_SCAN_LENGTH)
+        for pos in range(len(data)-rarspec.S_BLK_HDR.size, start-1, -1):
+            if ord(data[pos+2]) != rarspec.RAR_BLOCK_ENDARC:
+                continue
+            header = self._rs._parse_header(StringIO(data[pos:]))
+            if not header or header.type != rarspec.RAR_BLOCK_ENDARC:
+                continue
+            if header.volume_number is not None:
+                log.debug("%s is volume %d" % (self.file.filename, header.volume_number))
+                self.volume_number = header.volume_number
+            return header
+
+class SeekIndex(object):
+    """
+    Maps byte offsets in the extracted file to the segments holding them.
+
+    Each volume stores a slice of the extracted file: ``add_size`` bytes
+    starting at ``file_offset`` within the volume, both known from the file
+    header in the volume's first segment.  Every segment of a volume but the
+    last decodes to the same ``part_size`` bytes, so the segment holding any
+    byte can be found without downloading anything in between.
+    """
+    def __init__(self):
+        self.size       = 0     # Size of the extracted file covered so far
+        self.volumes    = []    # (payload offset, payload size, part size, first segment number)
+        self._starts    = []    # Offset in the extracted file of each volume's payload
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def add_volume(self, payload_offset, payload_size, part_size, first_segnum):
+        self._starts.append(self.size)
+        self.volumes.append((payload_offset, payload_size, part_size, first_segnum))
+        self.size += payload_size
+
+    def locate(self, offset):
+        """
+        Returns ``(volume, segnum, segment_offset)`` for byte ``offset`` of the
+        extracted file, where ``segnum`` is the stream segment number.
+        """
+        if offset < 0 or offset >= self.size:
+            raise IndexError("Offset %d outside of file" % offset)
+
+        volume = bisect.bisect_right(self._starts, offset)-1
+        payload_offset, payload_size, part_size, first_segnum = self.volumes[volume]
+        pos = payload_offset + offset - self._starts[volume]
+        return volume, first_segnum + pos // part_size, pos % part_size
+
+    def span(self, offset):
+        """
+        Like ``locate``, but also returns the number of bytes of the extracted
+        file that follow ``offset`` contiguously within the same segment.
+        """
+        volume, segnum, seg_offset = self.locate(offset)
+        payload_offset, payload_size, part_size, first_segnum = self.volumes[volume]
+        remaining = self._starts[volume] + payload_size - offset
+        return volume, segnum, seg_offset, min(part_size-seg_offset, remaining)
+
+class LayoutPlan(object):
+    """
+    Where the payload of every stream segment goes in the extracted file.
+
+    ``get`` returns ``(start, end, dest)``: bytes ``start`` to ``end`` of the
+    decoded segment are the bytes of the extracted file at ``dest``.  Segments
+    holding only headers have ``start == end``.  With the plan worked out up
+    front from the ``SeekIndex``, segments can be written as soon as they're
+    downloaded instead of in order through ``RarSet.read``.
+    """
+    def __init__(self, index, counts):
+        self.starts = []    # Start of the payload in every segment
+        self.ends   = []    # End of the payload in every segment
+        self.dests  = []    # Offset of the payload in the extracted file
+
+        for volume, count in enumerate(counts):
+            payload_offset, payload_size, part_size, first_segnum = index.volumes[volume]
+            payload_end = payload_offset + payload_size
+            for i in xrange(count):
+                seg_start = i * part_size
+                start = min(max(payload_offset, seg_start), seg_start + part_size)
+                end   = max(min(payload_end, seg_start + part_size), start)
+                self.starts.append(start - seg_start)
+                self.ends.append(end - seg_start)
+                self.dests.append(index._starts[volume] + max(0, start - payload_offset))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def get(self, segnum):
+        return self.starts[segnum], self.ends[segnum], self.dests[segnum]
+
+def get_single_member(members, wants):
+    """
+    Returns the name of the member every rarchive holds, going by
+    ``members`` as given to ``MemberPlan``, if that's the only member of the
+    rarset and it's wanted.  Returns ``None`` otherwise, or when the headers
+    of a rarchive weren't all read.  Only then do the payloads of the volumes
+    make up the extracted file, and only then is every segment streamed.
+    """
+    names = set()
+    for info in members or ():
+        if info is None or not info[1]:
+            return None
+        names.update(name for name, o, s, c in info[2])
+    if len(names) != 1:
+        return None
+    name = names.pop()
+    return name if wants(name) else None
+
+class MemberPlan(object):
+    """
+    Works out which stream segments can be left undownloaded when only some
+    members of the rarset are wanted.
+
+    ``members`` has, for every rarchive, ``(part_size, complete, files)`` as
+    given by ``RarVolume`` (``files`` from ``get_members``), or ``None`` if
+    its headers weren't read.  ``counts`` is the number of segments of every
+    rarchive and ``wants`` tells whether a member is wanted.
+
+    A segment lying entirely within the payload of an unwanted member is
+    dropped; ``skips`` holds, for the segment following a run of dropped
+    segments, the number of bytes the parser has to skip over.  A volume
+    whose files are all known and unwanted is dropped as a whole.  The last
+    segment of a volume is kept otherwise, so the parser always reaches the
+    end of the volume.  Segments of volumes whose headers weren't read are
+    always kept, and nothing is dropped when a wanted member is compressed:
+    the decompressor needs every byte of the archive.
+    """
+    def __init__(self, members, counts, wants):
+        self.dropped = set()    # Segment numbers not to download
+        self.skips   = {}       # segnum -> payload bytes skipped right before it
+        self.saved   = 0        # Bytes not downloaded
+
+        for info in members:
+            if info and any(compressed and wants(name) for name, o, s, compressed in info[2]):
+                log.debug("Compressed member wanted; downloading every segment")
+                return
+
+        first = 0
+        for info, count in zip(members, counts):
+            if info is not None:
+                self._plan_volume(info, count, first, wants)
+            first += count
+
+    def _plan_volume(self, info, count, first, wants):
+        part_size, complete, files = info
+        if complete and not any(wants(name) for name, o, s, c in files):
+            self.dropped.update(xrange(first, first+count))
+            self.saved += count*part_size  # Roughly; the last segment is shorter
+            return
+
+        skipped = 0
+        for segnum in xrange(count-1):
+            start = segnum*part_size
+            end   = start+part_size
+            if any(offset <= start and end <= offset+size and not wants(name)
+                   for name, offset, size, c in files):
+                self.dropped.add(first+segnum)
+                skipped += part_size
+            elif skipped:
+                self.skips[first+segnum] = skipped
+                self.saved += skipped
+                skipped = 0
+        if skipped:
+            self.skips[first+count-1] = skipped
+            self.saved += skipped
+
+class ChunkBuffer(object):
+    """
+    FIFO of bytes made up of the chunks given to ``BlockParser.feed``.  The
+    chunks are kept as memoryviews and taking bytes off the front slices
+    them, so payload data goes from the decoder to the writer without being
+    copied.  Only ``peek``, used for headers, copies.
+    """
+    def __init__(self):
+        self._chunks = collections.deque()
+        self._len    = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, data):
+        if data:
+            self._chunks.append(memoryview(data))
+            self._len += len(data)
+
+    def peek(self, size):
+        """
+        Returns up to ``size`` bytes from the front, as a string, without
+        removing them.
+        """
+        parts = []
+        for chunk in self._chunks:
+            if size <= 0:
+                break
+            parts.append(chunk[:size].tobytes())
+            size -= len(chunk)
+        return ''.join(parts)
+
+    def take(self, size):
+        """
+        Removes up to ``size`` bytes from the front and returns them as a list
+        of memoryviews.
+        """
+        pieces = []
+        while size > 0 and self._chunks:
+            chunk = self._chunks[0]
+            if len(chunk) <= size:
+                piece = self._chunks.popleft()
+            else:
+                piece = chunk[:size]
+                self._chunks[0] = chunk[size:]
+            pieces.append(piece)
+            size      -= len(piece)
+            self._len -= len(piece)
+        return pieces
+
+    def skip(self, size):
+        self.take(size)
+
+class BlockParser(object):
+    """
+    Push-style parser for the blocks of a RAR 1.5-4.x or RAR5 stream, telling
+    the formats apart by their signatures.  ``feed`` takes chunks of any size,
+    split anywhere, and returns the events completed by them:
+
+        * ``(EVENT_HEADER, header)`` once a whole block header has arrived
+        * ``(EVENT_DATA, header, data)`` for payload of the blocks in
+          ``payload_types``, as memoryviews into the fed chunks
+
+    Payload of any other block is skipped as it arrives, without being
+    buffered.  Each header is decoded exactly once; only the bytes of a header
+    that's still incomplete are held on to between calls.
+    """
+    STATE_BASE      = 0 # Waiting for the base block header
+    STATE_HEADER    = 1 # Waiting for the rest of the block header
+    STATE_PAYLOAD   = 2 # Passing on or skipping the block payload
+
+    def __init__(self, rs, payload_types=(rarspec.RAR_BLOCK_FILE,)):
+        self.payload_types  = payload_types
+        self.skipped        = 0     # Bytes of payload skipped
+
+        self._rs            = rs    # RarSpec used to decode headers
+        self._buf           = ChunkBuffer()
+        self._state         = self.STATE_BASE
+        self._header_size   = 0     # Size of the header being parsed
+        self._header        = None  # Header of the current block
+        self._remaining     = 0     # Bytes of payload left in the current block
+
+    def _get_header_size(self, base):
+        """
+        Returns the size of the block header starting with the
+        ``BASE_HEADER_SIZE`` bytes ``base``.  Signatures are parsed as blocks
+        of their own.
+        """
+        if base == rarspec.RAR5_ID[:BASE_HEADER_SIZE]:
+            return len(rarspec.RAR5_ID)
+        if base == rarspec.RAR_ID:
+            return len(rarspec.RAR_ID)
+
+        if self._rs._rar5:
+            try:
+                size, pos = rarspec.load_vint(base, 4)
+            except struct.error:
+                raise rarspec.BadRarFile("Invalid RAR5 block header size")
+            return pos+size
+
+        size = rarspec.S_BLK_HDR.unpack(base)[3]
+        if size < rarspec.S_BLK_HDR.size:
+            raise rarspec.BadRarFile("Invalid block header size: %d" % size)
+        return size
+
+    def skip(self, size):
+        """
+        Passes over ``size`` bytes of the current block's payload without them
+        being fed.  Raises ``BadRarFile`` outside of a payload.
+        """
+        if self._state != self.STATE_PAYLOAD or len(self._buf) or size > self._remaining:
+            raise rarspec.BadRarFile("Cannot skip %d bytes outside of a payload" % size)
+        self._remaining -= size
+        self.skipped    += size
+        if not self._remaining:
+            self._state = self.STATE_BASE
+
+    def feed(self, data):
+        self._buf.append(data)
+        events = []
+        while len(self._buf):
+            if self._state == self.STATE_BASE:
+                if len(self._buf) < BASE_HEADER_SIZE:
+                    break
+                self._header_size = self._get_header_size(self._buf.peek(BASE_HEADER_SIZE))
+                self._state = self.STATE_HEADER
+
+            elif self._state == self.STATE_HEADER:
+                if len(self._buf) < self._header_size:
+                    break
+                header = self._rs._parse_header(StringIO(self._buf.peek(self._header_size)))
+                if not header:
+                    raise rarspec.BadRarFile("Broken block header")
+                self._buf.skip(self._header_size)
+                events.append((EVENT_HEADER, header))
+
+                self._header    = header
+                self._remaining = header.add_size
+                self._state     = self.STATE_PAYLOAD if header.add_size else self.STATE_BASE
+
+            else:
+                for piece in self._buf.take(self._remaining):
+                    self._remaining -= len(piece)
+                    if self._header.type in self.payload_types:
+                        events.append((EVENT_DATA, self._header, piece))
+                    else:
+                        self.skipped += len(piece)
+                if not self._remaining:
+                    self._state = self.STATE_BASE
+        return events
+
 class RarSet(object):
     """
     A class for managing a set of rarchives, as defined:
@@ -55,27 +643,49 @@ class RarSet(object):
         +------+------+--------------------+------+------+------+-------------+
          header header     file contents    header header header file contents
 
+    Every member of the rarset is extracted in the same pass over the data:
+    each file header switches writing over to its own ``RarFile``, so extras
+    such as subtitles come out alongside the main file.  ``include`` and
+    ``exclude`` are lists of filename patterns (``fnmatch``, ignoring case);
+    members not included, or excluded, aren't written and their payload is
+    skipped.  The first wanted media member, ``main_file``, is the one
+    streamed and goes to ``output``; the others go to disk.
+
     """
-    def __init__(self, nzb):
+    def __init__(self, nzb, volumes=None, rarchives=None, output=None, fsync=writer.DEFAULT_FSYNC,
+                 use_mmap=False, password=None, include=None, exclude=None):
         self.name           = None  # Rarset name (without extension)
         self.first_rarchive = None  # Firs rarchive in the rarset
         self.rarchives      = []    # List of rarchives in rarset
-        self.files          = {}    # Files contained in the entire rarset
+        self.files          = collections.OrderedDict() # Files contained in the entire rarset, in order
+        self.skipped        = set() # Names of the members filtered out
+        self.include        = include or [] # Patterns of the members to extract; all if empty
+        self.exclude        = exclude or [] # Patterns of the members not to extract
         self.current_file   = None  # Current file in the rarset
+        self.main_file      = None  # First wanted media file: the one streamed
+        self.output         = output # File-like object extracted files are written to instead of disk
+        self.fsync          = fsync  # writer fsync policy for extracted files on disk
+        self.use_mmap       = use_mmap # Memory map extracted files on disk
+        self.password       = password # Password of encrypted files
+        self.keys           = {}       # (password, salt) -> (key, iv) derived for them
 
         self._offset            = 0             # Offset from beginning of extracted file
         self._segment           = None          # Current segments
         self._header            = None          # Current header
         self._header_read_size  = 0             # Number of bytes read from current archive
-        self._buf               = StringIO()    # Current buffer
+        self._parser            = None          # BlockParser for the streamed volumes
         self._fd                = None          # File handle for extracted file
         self._rs                = None          # RarFile instance
         self._headers           = []            # List of all headers found in total archive (all volumes)
         self._file_name         = ""            # Extracted file name
 
         self._rs = rarspec.RarSpec("", partial_ok=True, stream=True, parse=False)
+        self._parser = BlockParser(self._rs)
 
-        self._parse(nzb)
+        if rarchives:
+            self._set_rarchives(rarchives)
+        elif not volumes or not self._order_volumes(volumes):
+            self._parse(nzb)
 
     def __repr__(self):
         return "<RarSet: %s>" % self.name
@@ -94,6 +704,11 @@ class RarSet(object):
             if RAR_RE.search(file.filename):
                 self.rarchives.append(file)
 
+        if len(self.rarchives) == 1:
+            # A single volume; nothing to order
+            self._set_rarchives(self.rarchives)
+            return
+
         self.name, length = self._get_common_name(self.rarchives[0].filename, self.rarchives[1].filename)
         log.debug("Found archive name: %s" % self.name)
 
@@ -119,6 +734,49 @@ class RarSet(object):
         for rar in self.rarchives:
             log.debug("  %s" % rar.filename)
 
+    def _order_volumes(self, volumes):
+        """
+        Orders the rarchives by the volume numbers stored in their headers.
+        Returns ``False`` if the headers don't describe exactly one complete
+        rarset, in which case the filename heuristics should be used instead.
+        """
+        volumes = [v for v in volumes if v.is_rar]
+        if not volumes:
+            return False
+
+        for volume in volumes:
+            if volume.volume_number is None:
+                log.debug("No volume number for %s" % volume.file.filename)
+                return False
+
+        volumes = sorted(volumes, key=lambda v: v.volume_number)
+        if [v.volume_number for v in volumes] != range(len(volumes)):
+            log.debug("Volume numbers are not contiguous")
+            return False
+
+        if not volumes[0].first_volume or len([v for v in volumes if v.first_volume]) != 1:
+            log.debug("Could not determine first volume")
+            return False
+
+        self._set_rarchives([v.file for v in volumes])
+        return True
+
+    def _set_rarchives(self, rarchives):
+        """
+        Uses ``rarchives`` as the rarset, already in volume order.
+        """
+        self.rarchives      = list(rarchives)
+        self.first_rarchive = self.rarchives[0]
+        if len(self.rarchives) > 1:
+            self.name = self._get_common_name(self.rarchives[0].filename, self.rarchives[1].filename)[0]
+        else:
+            self.name = self.rarchives[0].filename.rsplit('.', 1)[0]
+        log.debug("Found archive name: %s" % self.name)
+
+        log.debug("Rarchives (in volume order):")
+        for rar in self.rarchives:
+            log.debug("  %s" % rar.filename)
+
     def _check_name(self, name, length):
         bits = name.split('.')
         if len(bits) != length+1:
@@ -131,7 +789,7 @@ class RarSet(object):
         count   = 0
 
         for i, v in enumerate(l1):
-            if l2[i] == v:
+            if i < len(l2) and l2[i] == v:
                 count += 1
             else:
                 break
@@ -143,6 +801,13 @@ class RarSet(object):
             for segment in rar.segments:
                 yield segment
 
+    def skip(self, size):
+        """
+        Skips ``size`` bytes of payload that weren't downloaded; see
+        ``MemberPlan``.
+        """
+        self._parser.skip(size)
+
     def reset(self):
         if self._fd:
             self._fd.close()
@@ -151,59 +816,81 @@ class RarSet(object):
         self._segment           = None
         self._header            = None
         self._header_read_size  = 0
-        self._buf               = StringIO()
+        self._parser            = BlockParser(self._rs)
         self._fd                = None
         self._file_name         = ""
 
-    def _find_file(self):
-        if not self.current_file or not self.current_file._header:
-            log.debug("Looking for headers")
-            headers = []
-            while True:
-                pos = self._buf.tell()
-                try:
-                    header = self._rs._parse_header(self._buf)
-                    if not header:
-                        self._buf.seek(pos)
-                        break
-                    log.debug("Found header type: %s" % RAR_HEADER_NAMES[header.type])
-                    headers.append(header)
-                    if header.type == rarspec.RAR_BLOCK_FILE:
-                        if not self.files.has_key(header.filename):
-                            log.debug("Creating new RarFile for %s" % header.filename)
-                            self.files[header.filename] = RarFile(header)
-                        else:
-                            log.debug("Continuing RarFile for %s" % header.filename)
-                            self.files[header.filename].add_header(header)
-
-                        self.current_file = self.files[header.filename]
-                        break
-                except Exception, e:
-                    log.error(e)
-                    self._buf.seek(pos)
-                    break
-
-            log.debug("Found %d headers" % len(headers))
-            self._headers.append(headers)
-
-        return self.current_file
+    def wants(self, filename):
+        """
+        Returns True if the member ``filename`` passes the include and exclude
+        patterns.
+        """
+        name = filename.lower()
+        if self.include and not any(fnmatch.fnmatch(name, p.lower()) for p in self.include):
+            return False
+        return not any(fnmatch.fnmatch(name, p.lower()) for p in self.exclude)
+
+    def get_progress(self):
+        """
+        Returns ``(filename, progress)`` of every member being extracted, in
+        the order they were found.
+        """
+        return [(name, rarfile.get_progress()) for name, rarfile in self.files.items()]
+
+    def is_complete(self):
+        """
+        Returns True if every member found so far has been extracted.
+        """
+        return all(rarfile.complete for rarfile in self.files.values())
+
+    def _add_header(self, header):
+        log.debug("Found header type: %s" % RAR_HEADER_NAMES.get(header.type, header.type))
+        self._headers.append(header)
+        if header.type != rarspec.RAR_BLOCK_FILE:
+            return
+
+        if header.isdir():
+            # Directories are created along with the files in them
+            log.debug("Skipping directory %s" % header.filename)
+            self.current_file = None
+            return
+
+        if not self.wants(header.filename):
+            if header.filename not in self.skipped:
+                log.debug("Skipping %s" % header.filename)
+                self.skipped.add(header.filename)
+            self.current_file = None
+            return
+
+        main = self.main_file is None and is_media(header.filename)
+        if header.filename not in self.files and header.compress_type != rarspec.RAR_M0 and not main:
+            # Only the streamed member gets a decompressor
+            if header.filename not in self.skipped:
+                log.info("Not extracting compressed member %s" % header.filename)
+                self.skipped.add(header.filename)
+            self.current_file = None
+            return
+
+        if not self.files.has_key(header.filename):
+            log.debug("Creating new RarFile for %s" % header.filename)
+            # A pipe takes the streamed member; the rest go to disk
+            output = self.output if main else None
+            self.files[header.filename] = RarFile(header, output, self.fsync, self.use_mmap,
+                                                  self.password, self.keys)
+            if main:
+                self.main_file = self.files[header.filename]
+        else:
+            log.debug("Continuing RarFile for %s" % header.filename)
+            self.files[header.filename].add_header(header)
+        self.current_file = self.files[header.filename]
 
     def read(self, data):
-        # Add the data into the buffer
-        data_len = len(data)
-        pos = self._buf.tell()
-        self._buf.write(data)
-        self._buf.seek(pos)
-
-        self.current_file = self._find_file()
-        if self.current_file:
-            bytes_written = self.current_file.write(self._buf)
-            if self.current_file.complete:
-                log.debug("File is complete")
-                self.current_file = None
-
-        # read remaining buffer, if any
-        data = self._buf.read()
-        self._buf.seek(0)
-        self._buf.truncate()
-        self._buf.write(data)
+        for event in self._parser.feed(data):
+            if event[0] == EVENT_HEADER:
+                self._add_header(event[1])
+            elif self.current_file and not self.current_file.compressed:
+                # Compressed files are written by an extract.Extractor
+                self.current_file.write(event[2])
+                if self.current_file.complete:
+                    log.debug("File is complete")
+                    self.current_file = None
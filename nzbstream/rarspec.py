@@ -83,6 +83,8 @@ from binascii import crc32
 from tempfile import mkstemp
 from subprocess import Popen, PIPE, STDOUT
 from datetime import datetime
+from time import gmtime
+from array import array
 
 # only needed for encryped headers
 try:
@@ -257,6 +259,52 @@ RAR_ENDARC_VOLNR        = 0x0008
 RAR_SKIP_IF_UNKNOWN     = 0x4000
 RAR_LONG_BLOCK          = 0x8000
 
+# RAR5 block types
+RAR5_BLOCK_MAIN         = 1
+RAR5_BLOCK_FILE         = 2
+RAR5_BLOCK_SERVICE      = 3
+RAR5_BLOCK_ENCRYPTION   = 4
+RAR5_BLOCK_ENDARC       = 5
+
+# flags common to all RAR5 blocks
+RAR5_BLOCK_FLAG_EXTRA_DATA      = 0x0001
+RAR5_BLOCK_FLAG_DATA_AREA       = 0x0002
+RAR5_BLOCK_FLAG_SKIP_IF_UNKNOWN = 0x0004
+RAR5_BLOCK_FLAG_SPLIT_BEFORE    = 0x0008
+RAR5_BLOCK_FLAG_SPLIT_AFTER     = 0x0010
+
+# flags for RAR5_BLOCK_MAIN
+RAR5_MAIN_FLAG_ISVOL    = 0x0001
+RAR5_MAIN_FLAG_HAS_VOLNR = 0x0002
+RAR5_MAIN_FLAG_SOLID    = 0x0004
+RAR5_MAIN_FLAG_RECOVERY = 0x0008
+RAR5_MAIN_FLAG_LOCKED   = 0x0010
+
+# flags for RAR5_BLOCK_FILE and RAR5_BLOCK_SERVICE
+RAR5_FILE_FLAG_ISDIR        = 0x0001
+RAR5_FILE_FLAG_HAS_MTIME    = 0x0002
+RAR5_FILE_FLAG_HAS_CRC32    = 0x0004
+RAR5_FILE_FLAG_UNKNOWN_SIZE = 0x0008
+
+# flags for RAR5_BLOCK_ENDARC
+RAR5_ENDARC_FLAG_NEXT_VOL   = 0x0001
+
+# extra area record types of RAR5_BLOCK_FILE
+RAR5_XFILE_ENCRYPTION   = 1
+
+# RAR5 host OS types
+RAR5_OS_WINDOWS = 0
+RAR5_OS_UNIX    = 1
+
+# RAR5 blocks are parsed into the equivalent RAR 1.5-4.x block types, so the
+# rest of the code handles both formats alike
+RAR5_BLOCK_TYPES = {
+    RAR5_BLOCK_MAIN:    RAR_BLOCK_MAIN,
+    RAR5_BLOCK_FILE:    RAR_BLOCK_FILE,
+    RAR5_BLOCK_SERVICE: RAR_BLOCK_SUB,
+    RAR5_BLOCK_ENDARC:  RAR_BLOCK_ENDARC,
+}
+
 # Host OS types
 RAR_OS_MSDOS = 0
 RAR_OS_OS2   = 1
@@ -278,6 +326,7 @@ RAR_M5 = 0x35
 ##
 
 RAR_ID = bytes("Rar!\x1a\x07\x00", 'ascii')
+RAR5_ID = bytes("Rar!\x1a\x07\x01\x00", 'ascii')
 ZERO = bytes("\0", 'ascii')
 EMPTY = bytes("", 'ascii')
 
@@ -312,8 +361,12 @@ class NoCrypto(Error):
 
 def is_rarfile(fn):
     '''Check quickly whether file is rar archive.'''
-    buf = open(fn, "rb").read(len(RAR_ID))
-    return buf == RAR_ID
+    buf = open(fn, "rb").read(len(RAR5_ID))
+    return is_rar_data(buf)
+
+def is_rar_data(buf):
+    '''Check whether buf starts with a RAR 1.5-4.x or RAR5 signature.'''
+    return buf.startswith(RAR_ID) or buf.startswith(RAR5_ID)
 
 
 class RarInfo(object):
@@ -344,6 +397,10 @@ class RarInfo(object):
         Volume nr, starting from 0.
     @ivar volume_file:
         Volume file name, where file starts.
+    @ivar volume_number:
+        For RAR_BLOCK_ENDARC, the volume number stored in the header (starting
+        from 0) or None if the archiver did not store it.  RAR5 archives store
+        it in the RAR_BLOCK_MAIN header instead.
     @ivar type:
         One of RAR_BLOCK_* types.  Only entries with type==RAR_BLOCK_FILE are shown in .infolist().
     @ivar flags:
@@ -399,6 +456,7 @@ class RarInfo(object):
         'header_offset',
         'salt',
         'volume_file',
+        'volume_number',
     )
 
     def isdir(self):
@@ -440,6 +498,7 @@ class RarSpec(object):
         self._partial_ok = partial_ok
         self._headers = []
         self._stream = stream
+        self._rar5 = False  # set once a RAR5 signature has been seen
 
         self._main = None
 
@@ -671,7 +730,9 @@ class RarSpec(object):
 
         self._fd = fd
         id = fd.read(len(RAR_ID))
-        if id != RAR_ID:
+        if id == RAR5_ID[:len(RAR_ID)] and fd.read(1) == RAR5_ID[-1:]:
+            self._rar5 = True
+        elif id != RAR_ID:
             raise NotRarFile("Not a Rar archive: "+self.rarfile)
 
         volume = 0  # first vol (.rar) is 0
@@ -750,6 +811,9 @@ class RarSpec(object):
     # read single header
     def _parse_header(self, fd):
         try:
+            if self._rar5:
+                return self._parse_rar5_header(fd)
+
             # handle encrypted headers
             if self._main and self._main.flags & RAR_MAIN_PASSWORD:
                 if not self._password:
@@ -768,11 +832,14 @@ class RarSpec(object):
         h = RarInfo()
         h.header_offset = fd.tell()
         h.comment = None
+        h.volume_number = None
 
         # read and parse base header
         buf = fd.read(S_BLK_HDR.size)
         if not buf:
             return None
+        if buf == RAR5_ID[:len(RAR_ID)]:
+            return self._parse_rar5_marker(h, buf, fd)
         t = S_BLK_HDR.unpack_from(buf)
         h.header_crc, h.type, h.flags, h.header_size = t
         h.header_base = S_BLK_HDR.size
@@ -816,6 +883,9 @@ class RarSpec(object):
             h.header_base += 8
         elif h.type == RAR_BLOCK_OLD_EXTRA:
             h.header_base += 7
+        elif h.type == RAR_BLOCK_ENDARC:
+            self._parse_endarc_header(h, pos)
+            h.header_base = h.header_size
         else:
             h.header_base = h.header_size
 
@@ -847,6 +917,156 @@ class RarSpec(object):
         # instead panicing, send eof
         return None
 
+    # RAR5 signature, returned as a marker block
+    def _parse_rar5_marker(self, h, buf, fd):
+        buf += fd.read(len(RAR5_ID) - len(buf))
+        if buf != RAR5_ID:
+            return None
+        self._rar5 = True
+        h.type = RAR_BLOCK_MARK
+        h.flags = 0
+        h.header_crc = None
+        h.header_size = h.header_base = len(RAR5_ID)
+        h.header_data = buf
+        h.add_size = 0
+        h.file_offset = fd.tell()
+        return h
+
+    # RAR5 block header
+    def _parse_rar5_header(self, fd):
+        h = RarInfo()
+        h.header_offset = fd.tell()
+        h.comment = None
+        h.volume_number = None
+
+        # crc and header size, the size is a vint of at most 3 bytes
+        buf = fd.read(7)
+        if not buf:
+            return None
+        if buf == RAR5_ID[:len(RAR_ID)]:
+            return self._parse_rar5_marker(h, buf, fd)
+
+        h.header_crc = S_LONG.unpack_from(buf)[0]
+        size, pos = load_vint(buf, 4)
+        h.header_size = pos + size
+        h.header_data = buf + fd.read(h.header_size - len(buf))
+        h.header_base = h.header_size
+        h.file_offset = fd.tell()
+
+        # unexpected EOF?
+        if len(h.header_data) != h.header_size:
+            if REPORT_BAD_HEADER:
+                raise BadRarFile('Unexpected EOF when reading header')
+            return None
+
+        # the crc covers everything from the header size on
+        calc_crc = crc32(h.header_data[4:]) & 0xFFFFFFFF
+        if h.header_crc != calc_crc:
+            if REPORT_BAD_HEADER:
+                raise BadRarFile('Header CRC error: exp=%x got=%x' % (h.header_crc, calc_crc))
+            return None
+
+        block_type, pos = load_vint(h.header_data, pos)
+        block_flags, pos = load_vint(h.header_data, pos)
+        extra_size = 0
+        if block_flags & RAR5_BLOCK_FLAG_EXTRA_DATA:
+            extra_size, pos = load_vint(h.header_data, pos)
+        h.add_size = 0
+        if block_flags & RAR5_BLOCK_FLAG_DATA_AREA:
+            h.add_size, pos = load_vint(h.header_data, pos)
+
+        h.type = RAR5_BLOCK_TYPES.get(block_type, block_type)
+        h.flags = 0
+        if block_type == RAR5_BLOCK_MAIN:
+            self._parse_rar5_main_header(h, pos)
+        elif block_type in (RAR5_BLOCK_FILE, RAR5_BLOCK_SERVICE):
+            self._parse_rar5_file_header(h, pos, block_flags, h.header_size - extra_size)
+        elif block_type == RAR5_BLOCK_ENCRYPTION:
+            raise NoCrypto('Cannot parse encrypted RAR5 headers')
+        elif block_type == RAR5_BLOCK_ENDARC:
+            end_flags, pos = load_vint(h.header_data, pos)
+            if end_flags & RAR5_ENDARC_FLAG_NEXT_VOL:
+                h.flags |= RAR_ENDARC_NEXT_VOLUME
+        return h
+
+    # read RAR5 main archive header
+    def _parse_rar5_main_header(self, h, pos):
+        arc_flags, pos = load_vint(h.header_data, pos)
+
+        # volume numbers are only stored from the second volume on
+        h.volume_number = 0
+        if arc_flags & RAR5_MAIN_FLAG_HAS_VOLNR:
+            h.volume_number, pos = load_vint(h.header_data, pos)
+
+        h.flags = RAR_MAIN_NEWNUMBERING
+        if arc_flags & RAR5_MAIN_FLAG_ISVOL:
+            h.flags |= RAR_MAIN_VOLUME
+        if h.volume_number == 0:
+            h.flags |= RAR_MAIN_FIRSTVOLUME
+        if arc_flags & RAR5_MAIN_FLAG_SOLID:
+            h.flags |= RAR_MAIN_SOLID
+        if arc_flags & RAR5_MAIN_FLAG_RECOVERY:
+            h.flags |= RAR_MAIN_RECOVERY
+        if arc_flags & RAR5_MAIN_FLAG_LOCKED:
+            h.flags |= RAR_MAIN_LOCK
+        return pos
+
+    # read RAR5 file or service header
+    def _parse_rar5_file_header(self, h, pos, block_flags, extra_pos):
+        data = h.header_data
+        file_flags, pos = load_vint(data, pos)
+        h.file_size, pos = load_vint(data, pos)
+        h.mode, pos = load_vint(data, pos)
+        h.compress_size = h.add_size
+
+        h.mtime = h.atime = h.ctime = h.arctime = None
+        h.date_time = (1980, 1, 1, 0, 0, 0)
+        if file_flags & RAR5_FILE_FLAG_HAS_MTIME:
+            h.date_time = gmtime(S_LONG.unpack_from(data, pos)[0])[:6]
+            pos += 4
+        h.CRC = 0
+        if file_flags & RAR5_FILE_FLAG_HAS_CRC32:
+            h.CRC = S_LONG.unpack_from(data, pos)[0]
+            pos += 4
+
+        compress_info, pos = load_vint(data, pos)
+        h.extract_version = compress_info & 0x3f
+        h.compress_type = RAR_M0 + ((compress_info >> 7) & 7)
+        host_os, pos = load_vint(data, pos)
+        h.host_os = RAR_OS_UNIX if host_os == RAR5_OS_UNIX else RAR_OS_WIN32
+
+        h.name_size, pos = load_vint(data, pos)
+        h.orig_filename = data[pos : pos + h.name_size]
+        h.filename = h.orig_filename.decode('utf-8', 'replace')
+        pos += h.name_size
+
+        # RAR5 uses '/' internally
+        if PATH_SEP != '/':
+            h.filename = h.filename.replace('/', PATH_SEP)
+
+        if block_flags & RAR5_BLOCK_FLAG_SPLIT_BEFORE:
+            h.flags |= RAR_FILE_SPLIT_BEFORE
+        if block_flags & RAR5_BLOCK_FLAG_SPLIT_AFTER:
+            h.flags |= RAR_FILE_SPLIT_AFTER
+        if compress_info & 0x40:
+            h.flags |= RAR_FILE_SOLID
+        if file_flags & RAR5_FILE_FLAG_ISDIR:
+            h.flags |= RAR_FILE_DIRECTORY
+
+        # only the encryption record of the extra area matters here
+        h.salt = None
+        pos = extra_pos
+        while pos < h.header_size:
+            rec_size, rec_pos = load_vint(data, pos)
+            rec_type = load_vint(data, rec_pos)[0]
+            if rec_type == RAR5_XFILE_ENCRYPTION:
+                h.flags |= RAR_FILE_PASSWORD
+            pos = rec_pos + rec_size
+
+        if USE_DATETIME:
+            h.date_time = to_datetime(h.date_time)
+        return pos
+
     # read file-specific header
     def _parse_file_header(self, h, pos):
         fld = S_FILE_HDR.unpack_from(h.header_data, pos)
@@ -924,6 +1144,17 @@ class RarSpec(object):
 
         return pos
 
+    # read end of archive header
+    def _parse_endarc_header(self, h, pos):
+        if h.flags & RAR_ENDARC_DATACRC:
+            pos += 4
+        if h.flags & RAR_ENDARC_VOLNR and pos + 2 <= len(h.header_data):
+            h.volume_number = S_SHORT.unpack_from(h.header_data, pos)[0]
+            pos += 2
+        else:
+            h.volume_number = None
+        return pos
+
     # find old-style comment subblock
     def _parse_subblocks(self, h, pos):
         hdata = h.header_data
@@ -1597,22 +1828,67 @@ class HeaderDecrypt:
 
         return res
 
+class PayloadDecrypt:
+    """Decrypts file data as it arrives, in pieces of any size"""
+    def __init__(self, key, iv):
+        self.ciph = AES.new(key, AES.MODE_CBC, iv)
+        self.buf = EMPTY
+
+    def decrypt(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if self.buf:
+            data = self.buf + data
+
+        # only whole blocks can be decrypted, keep the rest for later
+        BLK = self.ciph.block_size
+        cnt = len(data) - len(data) % BLK
+        self.buf = data[cnt:]
+        if not cnt:
+            return EMPTY
+        return self.ciph.decrypt(data[:cnt])
+
 ##
 ## Utility functions
 ##
 
 def rar3_s2k(psw, salt):
-    """String-to-key hash for RAR3."""
+    """String-to-key hash for RAR3.
+
+    The hash runs over 0x40000 rounds of password, salt and a 3-byte round
+    counter.  Rather than one sha1 update per round, the input of each 0x4000
+    rounds is laid out in one buffer and hashed with a single update; the IV
+    bytes come from a copy of the hash after the first round of each.
+    """
 
     seed = psw.encode('utf-16le') + salt
+    rec = len(seed) + 3
+    rounds = 0x4000
+    block = bytearray(rec * rounds)
+    for k in range(len(seed)):
+        block[k::rec] = seed[k:k+1] * rounds
+    view = memoryview(block)
+
+    # Little-endian counters: within a block of rounds the low byte and the
+    # low 6 bits of the middle byte count up, the rest is the block number.
+    cnt = array('I', range(rounds))
+    if sys.byteorder == 'big':
+        cnt.byteswap()
+    size = cnt.itemsize
+    cnt = cnt.tostring()
+    block[len(seed)::rec] = cnt[0::size]
+    mid = [bytes(bytearray((x + (n << 6)) & 0xff for x in range(256)), 'latin-1')
+           for n in range(4)]
+
     iv = EMPTY
     h = sha1()
     for i in range(16):
-        for j in range(0x4000):
-            cnt = S_LONG.pack(i*0x4000 + j)
-            h.update(seed + cnt[:3])
-            if j == 0:
-                iv += h.digest()[19:20]
+        block[len(seed)+1::rec] = cnt[1::size].translate(mid[i & 3])
+        block[len(seed)+2::rec] = pack('B', i >> 2) * rounds
+
+        h.update(view[:rec])
+        iv += h.copy().digest()[19:20]
+        h.update(view[rec:])
     key_be = h.digest()[:16]
     key_le = pack("<LLLL", *unpack(">LLLL", key_be))
     return key_le, iv
@@ -1705,6 +1981,20 @@ def to_datetime(t):
             day = 28
     return datetime(year, mon, day, h, m, s, us)
 
+def load_vint(buf, pos):
+    """Load RAR5 variable length integer, returns (value, new pos)."""
+
+    res = shift = 0
+    while True:
+        if pos >= len(buf):
+            raise struct.error('vint past end of buffer')
+        b = ord(buf[pos])
+        res |= (b & 0x7f) << shift
+        pos += 1
+        if not b & 0x80:
+            return res, pos
+        shift += 7
+
 def parse_dos_time(stamp):
     """Parse standard 32-bit DOS timestamp."""
 
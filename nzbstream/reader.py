@@ -0,0 +1,117 @@
+"""
+File-like access to the file being extracted, for embedding nzbstream.
+
+Tools built around nzbstream used to poll the output file on disk.  Instead,
+``Manager.open`` returns a ``StreamReader`` which behaves like the file objects
+returned by ``rarspec.RarSpec.open``, except that reads block until the bytes
+have been downloaded.  Reading or seeking ahead of the download moves the
+segments at the read position to the front of the queue.
+"""
+
+import logging
+import os
+
+try:
+    from io import RawIOBase
+except ImportError:
+    class RawIOBase(object):
+        def close(self):
+            pass
+
+log = logging.getLogger('nzbstream.reader')
+
+class StreamReader(RawIOBase):
+    """
+    Read-only, seekable view of the extracted file of a ``Manager``.
+
+    Behaviour:
+     - no short reads - .read() and .readinto() block until as much as
+       requested is available or the end of the file is reached.
+     - no internal buffer, data comes from ``Manager.read_at``, which reads
+       from the downloaded segments in memory when they're still there.
+     - .readinto() copies straight out of the mapping of a memory mapped
+       extracted file.
+
+    @ivar name:
+      filename of the extracted file.
+    """
+
+    def __init__(self, manager, timeout=None):
+        RawIOBase.__init__(self)
+
+        self.manager = manager
+        self.timeout = timeout
+        self.name    = manager.current_file.filename
+        self.mode    = 'rb'
+        self.size    = manager.current_file.file_size
+        self._pos    = 0
+
+    def _read(self, cnt):
+        """Read up to cnt bytes, one contiguous piece at a time."""
+        pieces = []
+        while cnt > 0 and self._pos < self.size:
+            data = self.manager.read_at(self._pos, cnt, self.timeout)
+            if data is None:
+                raise IOError("Timed out reading %s at %d" % (self.name, self._pos))
+            if not data:
+                break
+            pieces.append(data)
+            self._pos += len(data)
+            cnt -= len(data)
+        return ''.join(pieces)
+
+    def read(self, cnt=None):
+        """Read all or specified amount of data."""
+        if cnt is None or cnt < 0:
+            cnt = self.size-self._pos
+        return self._read(cnt)
+
+    def readall(self):
+        """Read all remaining data"""
+        return self.read()
+
+    def readinto(self, buf):
+        """Read directly into buffer.
+
+        Returns bytes read.
+        """
+        view = memoryview(buf)
+        got  = 0
+        while got < len(view) and self._pos < self.size:
+            data = self.manager.read_at(self._pos, len(view)-got, self.timeout, view=True)
+            if data is None:
+                raise IOError("Timed out reading %s at %d" % (self.name, self._pos))
+            if not data:
+                break
+            view[got:got+len(data)] = data
+            got       += len(data)
+            self._pos += len(data)
+        return got
+
+    def tell(self):
+        """Return current reading position."""
+        return self._pos
+
+    def seek(self, ofs, whence=os.SEEK_SET):
+        """Seek in data.  Seeking ahead of the download reprioritizes it."""
+        if whence == os.SEEK_SET:
+            new_ofs = ofs
+        elif whence == os.SEEK_CUR:
+            new_ofs = self._pos + ofs
+        elif whence == os.SEEK_END:
+            new_ofs = self.size + ofs
+        else:
+            raise ValueError('Invalid value for whence')
+
+        self._pos = max(0, min(new_ofs, self.size))
+        if self._pos < self.size and not self.manager.is_available(self._pos):
+            self.manager.seek(self._pos)
+        return self._pos
+
+    def readable(self):
+        """Returns True"""
+        return True
+
+    def seekable(self):
+        """Returns True"""
+        return True
@@ -0,0 +1,241 @@
+"""
+Deadline driven scheduling and throttling of stream segments.
+
+Queuing every segment in stream order ignores where the player actually is:
+after a seek the segments it needs next wait behind everything before them.
+The ``ReadAheadScheduler`` instead gives every segment within ``read_ahead``
+seconds of the consumer's position a deadline, the time playback will reach
+it at the detected bitrate, and the server fetches those earliest deadline
+first.  All other segments are queued behind them at background priority, so
+spare connections keep completing the file without holding up playback.
+
+Once fetching on time is taken care of, the ``BufferThrottle`` decides how fast
+to fetch.  It looks at how many seconds of media are downloaded ahead of the
+consumer and throttles the server to keep that near a target: unthrottled
+while the buffer is low, close to the bitrate once it's full, so that a shared
+line isn't hogged by a stream that's already well ahead.
+
+Positions are tracked in segments.  The encoded segment sizes from the NZB
+are within a few percent of the decoded sizes, which is plenty to work out
+deadlines with.
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+from array import array
+
+log = logging.getLogger('nzbstream.scheduler')
+
+DEFAULT_READ_AHEAD  = 30            # Seconds of media fetched ahead of the position
+FALLBACK_SEGMENTS   = 50            # Segments fetched ahead while the bitrate is unknown
+BACKGROUND_PRIORITY = float('inf')  # Priority of segments outside the read-ahead window
+
+DEFAULT_BUFFER_TARGET = 60  # Seconds of media the throttle aims to keep buffered
+THROTTLE_INTERVAL     = 1   # Seconds between throttle updates
+MIN_RATE_MULT         = 1.1 # Throttle, relative to the bitrate, with a full buffer
+MAX_RATE_MULT         = 4   # Throttle, relative to the bitrate, just above half full
+
+class ReadAheadScheduler(object):
+    """
+    Earliest deadline first scheduling of the segments of a ``Manager``.  The
+    position is where the stream has got to, or, once a reader has reported
+    one with ``seek``, where the reader is.  ``background`` limits how many
+    segments are queued ahead of the stream; ``None`` queues them all.
+    """
+    def __init__(self, manager, read_ahead=DEFAULT_READ_AHEAD, background=None):
+        self.manager    = manager
+        self.read_ahead = read_ahead
+        self.background = background
+        self.bitrate    = 0     # Bits per second, 0 while unknown
+        self.position   = 0     # Segment number the consumer is at
+
+        self._started   = False
+        self._reader    = False # True once a reader has reported its position
+        self._stream    = 0     # Next segment the stream will consume
+        self._play_start = None # When playback is assumed to have started
+        self._queued_to = 0     # Segments before this have been queued
+        self._urgent    = {}    # segnum -> deadline, for segments in the read-ahead window
+        self._lock      = threading.RLock() # Readers and the stream both update
+
+        # Offset of every segment from the start of the stream, in bytes
+        sizes = manager.table.sizes
+        self._offsets = array('d', [0])
+        for index in manager.segments:
+            self._offsets.append(self._offsets[-1]+sizes[index])
+
+    def __len__(self):
+        return len(self._offsets)-1
+
+    def start(self, position=0):
+        """
+        Queues the read-ahead window from ``position`` and everything after it
+        in the background.
+        """
+        self._started = True
+        self._stream  = position
+        if not self._reader:
+            self.position = position
+        self.update()
+
+    def advance(self, segnum):
+        """
+        The stream has consumed ``segnum``.
+        """
+        self._stream = segnum+1
+        if not self._reader:
+            self.position = segnum+1
+        if self._started:
+            self.update()
+
+    def seek(self, segnum):
+        """
+        A reader is at ``segnum``.
+        """
+        self._reader = True
+        if segnum != self.position:
+            self.position = segnum
+            self.update()
+
+    def set_bitrate(self, bitrate):
+        self.bitrate = bitrate
+        if self._play_start is None:
+            self._play_start = time.time()
+        log.debug("Bitrate set to %d; read-ahead is %ds" % (bitrate, self.read_ahead))
+        self.update()
+
+    def get_window(self):
+        """
+        Returns ``(segnum, seconds)`` for every segment in the read-ahead
+        window, where ``seconds`` is how long until playback gets there.
+        """
+        count  = len(self)
+        last   = count
+        if self.background is not None:
+            last = min(count, self.position+self.background)
+
+        window = []
+        if not self.bitrate:
+            for segnum in range(self.position, min(last, self.position+FALLBACK_SEGMENTS)):
+                window.append((segnum, segnum-self.position))
+            return window
+
+        byterate = self.bitrate/8.0
+        start    = self._offsets[self.position] if self.position < count else 0
+        for segnum in xrange(self.position, last):
+            seconds = (self._offsets[segnum]-start)/byterate
+            if seconds > self.read_ahead:
+                break
+            window.append((segnum, seconds))
+        return window
+
+    def get_consumer_offset(self):
+        """
+        Returns how far the consumer has got, in bytes from the start of the
+        stream.  That's the reader position if there is one.  Otherwise the
+        player is assumed to have started playing when the bitrate became
+        known and to have kept playing at the bitrate since.
+        """
+        if self._reader or not self._play_start:
+            return self._offsets[min(self.position, len(self))]
+        played = (time.time()-self._play_start)*self.bitrate/8.0
+        return min(played, self._offsets[min(self._stream, len(self))])
+
+    def get_buffered(self):
+        """
+        Returns the seconds of media downloaded ahead of the consumer, or
+        ``None`` while the bitrate is unknown.
+        """
+        if not self.bitrate:
+            return None
+
+        offset = self.get_consumer_offset()
+        segnum = max(0, bisect.bisect_right(self._offsets, offset)-1)
+        while segnum < len(self) and self.manager.is_downloaded(segnum):
+            segnum += 1
+        return max(0, self._offsets[segnum]-offset)/(self.bitrate/8.0)
+
+    def update(self):
+        """
+        Gives the segments that just entered the read-ahead window their
+        deadline, sends those that left it to the background and tops up the
+        background queue.
+        """
+        self._lock.acquire()
+        try:
+            self._update()
+        finally:
+            self._lock.release()
+
+    def _update(self):
+        now    = time.time()
+        window = self.get_window()
+        inside = set(segnum for segnum, seconds in window)
+
+        for segnum in self._urgent.keys():
+            if segnum not in inside:
+                del self._urgent[segnum]
+                self.manager.move_segment(segnum, BACKGROUND_PRIORITY)
+
+        for segnum, seconds in window:
+            if segnum not in self._urgent:
+                self._urgent[segnum] = now+seconds
+                self.manager.move_segment(segnum, now+seconds)
+
+        if not self._started:
+            return
+        last = len(self)
+        if self.background is not None:
+            last = min(last, self._stream+self.background)
+        while self._queued_to < last:
+            self.manager.queue_segment(self._queued_to, BACKGROUND_PRIORITY)
+            self._queued_to += 1
+
+class BufferThrottle(object):
+    """
+    Throttles ``server`` to keep ``target`` seconds of media buffered ahead of
+    the consumer of ``scheduler``.  Below half the target the server is
+    unthrottled; from there to the target the throttle drops linearly from
+    ``MAX_RATE_MULT`` to ``MIN_RATE_MULT`` times the bitrate, where it stays.
+    """
+    def __init__(self, server, scheduler, target=DEFAULT_BUFFER_TARGET):
+        self.server     = server
+        self.scheduler  = scheduler
+        self.target     = target
+        self.rate       = 0     # Current throttle, in bits per second; 0 is unthrottled
+        self.buffered   = None  # Seconds buffered at the last update
+
+        self._last      = 0
+
+    def get_rate(self, buffered):
+        """
+        Returns the throttle for ``buffered`` seconds of buffer.  Without a
+        target there's nothing to throttle to.
+        """
+        low = self.target/2.0
+        if buffered < low or self.target <= 0:
+            return 0
+        fill = min(1.0, (buffered-low)/(self.target-low))
+        return self.scheduler.bitrate*(MAX_RATE_MULT-(MAX_RATE_MULT-MIN_RATE_MULT)*fill)
+
+    def update(self):
+        """
+        Adjusts the throttle to the current buffer level, at most once every
+        ``THROTTLE_INTERVAL`` seconds.
+        """
+        now = time.time()
+        if now-self._last < THROTTLE_INTERVAL:
+            return
+        self._last = now
+
+        self.buffered = self.scheduler.get_buffered()
+        if self.buffered is None:
+            return
+
+        rate = self.get_rate(self.buffered)
+        if rate != self.rate:
+            log.debug("Buffered %.1fs of %ds; throttle %d -> %d" % (self.buffered, self.target, self.rate, rate))
+            self.rate = rate
+            self.server.set_throttle(rate)
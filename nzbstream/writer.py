@@ -0,0 +1,392 @@
+"""
+Write-behind output for the extracted file.
+
+``RarSet.read`` used to write every segment straight to the extracted file,
+so a slow disk (a NAS, say) held up segment processing and, through it, the
+download.  ``WriteBehind`` takes the writes instead: buffers are put on a
+bounded queue and a dedicated thread writes them out, coalescing adjacent
+buffers into larger writes.  The consumer only blocks when the queue is full.
+
+How often the data is fsync'ed is up to the ``fsync`` policy:
+
+    * ``'never'``  - leave it to the OS
+    * ``'close'``  - once, when the file is closed (the default)
+    * ``'batch'``  - after every write
+    * a number     - at most every that many seconds
+
+Time spent writing and syncing is counted in ``disk_time``; time the consumer
+spent waiting on a full queue is ``stall_time``.  Neither includes any network
+time.
+
+When the final size is known the file is preallocated up front, with
+``fallocate`` where the filesystem supports it and as a sparse file otherwise,
+so large files aren't grown one append at a time.  Writes go to absolute
+offsets and the ranges that have made it to the file are tracked in a
+``RangeMap``, so data doesn't have to arrive in order.
+
+``MappedOutput`` is the alternative for local consumers, such as the HTTP
+server: the preallocated file is mapped into memory, decoded bytes are copied
+into the mapping once and readers are handed slices of the mapping instead
+of reading the data back through the page cache.
+"""
+
+import bisect
+import collections
+import logging
+import mmap
+import os
+import threading
+import time
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate = getattr(_libc, 'fallocate64', None) or _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+except (ImportError, OSError, AttributeError, TypeError):
+    _fallocate = None
+
+log = logging.getLogger('nzbstream.writer')
+
+FSYNC_NEVER         = 'never'
+FSYNC_CLOSE         = 'close'
+FSYNC_BATCH         = 'batch'
+DEFAULT_FSYNC       = FSYNC_CLOSE
+MAX_QUEUED          = 32 * 1024 * 1024 # 32 MB, in bytes
+COALESCE_SIZE       = 4 * 1024 * 1024  # 4 MB, in bytes
+
+def preallocate(fd, size):
+    """
+    Reserves ``size`` bytes for the file open as ``fd``.  Returns True if the
+    space was allocated, False if the file was only extended (sparse).
+    """
+    if _fallocate is not None and _fallocate(fd, 0, 0, size) == 0:
+        return True
+    os.ftruncate(fd, size)
+    return False
+
+def view(buf, offset, size):
+    """
+    Returns a slice of ``buf`` without copying.  Python 2 can't make a
+    memoryview of an mmap, so that's a buffer object there.
+    """
+    try:
+        return memoryview(buf)[offset:offset+size]
+    except TypeError:
+        return buffer(buf, offset, size)
+
+def join(parts, size):
+    """
+    Returns ``parts``, strings or memoryviews of ``size`` bytes in total, as
+    one buffer.  Python 2 can't join memoryviews.
+    """
+    if len(parts) == 1:
+        return parts[0]
+    buf = bytearray(size)
+    pos = 0
+    for part in parts:
+        buf[pos:pos+len(part)] = part
+        pos += len(part)
+    return buf
+
+def parse_fsync(policy):
+    """
+    Returns the fsync policy for ``policy`` as given on the command line.
+    """
+    if policy in (FSYNC_NEVER, FSYNC_CLOSE, FSYNC_BATCH):
+        return policy
+    try:
+        return float(policy)
+    except ValueError:
+        raise ValueError("Invalid fsync policy: %s" % policy)
+
+class RangeMap(object):
+    """
+    Sorted, merged ``[start, end)`` byte ranges.
+    """
+    def __init__(self):
+        self._starts = []
+        self._ends   = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        return iter(zip(self._starts, self._ends))
+
+    def add(self, start, end):
+        # Merge with every range overlapping or touching [start, end)
+        i = bisect.bisect_left(self._ends, start)
+        j = bisect.bisect_right(self._starts, end)
+        if i < j:
+            start = min(start, self._starts[i])
+            end   = max(end, self._ends[j-1])
+        self._starts[i:j] = [start]
+        self._ends[i:j]   = [end]
+
+    def get_length(self, offset):
+        """
+        Returns the number of bytes in the map starting at ``offset``.
+        """
+        i = bisect.bisect_right(self._starts, offset)-1
+        if i < 0 or self._ends[i] <= offset:
+            return 0
+        return self._ends[i]-offset
+
+class WriteBehind(object):
+    """
+    Write-only file-like object for ``path``.  ``write`` appends, ``write_at``
+    writes at an absolute offset; both return as soon as the data is queued.
+    ``ranges`` holds the ranges that have made it to the file and can be read
+    back.  The file is preallocated to ``size``, if given.
+    """
+    def __init__(self, path, fsync=DEFAULT_FSYNC, size=None, max_queued=MAX_QUEUED):
+        self.path       = path
+        self.name       = path
+        self.fsync      = fsync
+        self.size       = size
+        self.max_queued = max_queued
+        self.ranges     = RangeMap()
+        self.disk_time  = 0     # Seconds spent writing and syncing
+        self.stall_time = 0     # Seconds writers waited on a full queue
+        self.error      = None
+
+        self._fd        = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        if size:
+            allocated = preallocate(self._fd, size)
+            log.debug("%s %s to %d bytes" % ("Allocated" if allocated else "Extended", path, size))
+        self._offset    = 0     # Offset of the next append
+        self._queue     = collections.deque()   # (offset, data)
+        self._queued    = 0     # Bytes in the queue
+        self._closed    = False
+        self._synced    = time.time()
+        self._cond      = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name="Writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        self.write_at(self._offset, data)
+        self._offset += len(data)
+
+    def write_at(self, offset, data):
+        if not data:
+            return
+        with self._cond:
+            if self.error:
+                raise IOError("Could not write %s: %s" % (self.path, self.error))
+            if self._closed:
+                raise IOError("Write to closed file %s" % self.path)
+
+            start = time.time()
+            while self._queued and self._queued+len(data) > self.max_queued and not self.error:
+                self._cond.wait()
+            self.stall_time += time.time()-start
+
+            self._queue.append((offset, data))
+            self._queued += len(data)
+            self._cond.notify_all()
+
+    def flush(self):
+        # The writer thread writes continuously; see sync() to wait for it
+        pass
+
+    def sync(self):
+        """
+        Blocks until everything queued so far has been written.
+        """
+        with self._cond:
+            while self._queued and not self.error:
+                self._cond.wait()
+
+    def tell(self):
+        return self._offset
+
+    def get_written(self, offset=0):
+        """
+        Returns the number of bytes from ``offset`` on that are in the file.
+        """
+        with self._cond:
+            return self.ranges.get_length(offset)
+
+    def get_prefix(self):
+        return self.get_written(0)
+    written = property(get_prefix)
+
+    def _take(self):
+        """
+        Takes the next write off the queue, merged with the writes directly
+        following it, up to ``COALESCE_SIZE``.  Returns ``None`` once the file
+        has been closed and the queue drained.
+        """
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return None
+
+            offset, data = self._queue.popleft()
+            parts = [data]
+            end   = offset+len(data)
+            size  = len(data)
+            while self._queue and size < COALESCE_SIZE and self._queue[0][0] == end:
+                data   = self._queue.popleft()[1]
+                parts.append(data)
+                end   += len(data)
+                size  += len(data)
+            return offset, parts, size
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._take()
+                if batch is None:
+                    break
+                offset, parts, size = batch
+
+                start = time.time()
+                self._write(offset, join(parts, size))
+                if self.fsync == FSYNC_BATCH or (not isinstance(self.fsync, basestring)
+                                                 and start-self._synced >= self.fsync):
+                    os.fsync(self._fd)
+                    self._synced = time.time()
+                self.disk_time += time.time()-start
+
+                with self._cond:
+                    self.ranges.add(offset, offset+size)
+                    self._queued -= size
+                    self._cond.notify_all()
+        except (IOError, OSError), e:
+            log.error("Could not write %s: %s" % (self.path, e))
+            with self._cond:
+                self.error = e
+                self._queue.clear()
+                self._queued = 0
+                self._cond.notify_all()
+
+    def _write(self, offset, data):
+        # No os.pwrite before Python 3.3; only this thread moves the file
+        # position, so seeking first is just as good.
+        if hasattr(os, 'pwrite'):
+            while data:
+                count   = os.pwrite(self._fd, data, offset)
+                data    = data[count:]
+                offset += count
+            return
+
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        while data:
+            count = os.write(self._fd, data)
+            data  = data[count:]
+
+    def close(self):
+        """
+        Waits for the queued writes, syncs unless the policy is ``'never'``
+        and closes the file.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+        if self.fsync != FSYNC_NEVER and not self.error:
+            start = time.time()
+            os.fsync(self._fd)
+            self.disk_time += time.time()-start
+        os.close(self._fd)
+        log.debug("Closed %s; %.2fs writing, %.2fs stalled" % (self.path, self.disk_time, self.stall_time))
+
+    def is_closed(self):
+        return self._closed
+    closed = property(is_closed)
+
+class MappedOutput(object):
+    """
+    Write-only file-like object for ``path``, created at ``size`` bytes and
+    memory mapped.  Writes are copied straight into the mapping; ``view``
+    returns slices of the written ranges.  Only an ``fsync`` policy of
+    ``'never'`` skips flushing the mapping on close, which otherwise leaves
+    writing it out to the OS.  The mapping stays valid after ``close`` so
+    readers can keep using their views.
+    """
+    def __init__(self, path, size, fsync=DEFAULT_FSYNC):
+        self.path       = path
+        self.name       = path
+        self.size       = size
+        self.fsync      = fsync
+        self.ranges     = RangeMap()
+        self.disk_time  = 0     # Seconds spent flushing the mapping
+        self.stall_time = 0
+
+        self._fd        = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        self._offset    = 0     # Offset of the next append
+        self._closed    = False
+        self._lock      = threading.Lock()
+
+        preallocate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size) if size else ''
+
+    def write(self, data):
+        self.write_at(self._offset, data)
+        self._offset += len(data)
+
+    def write_at(self, offset, data):
+        if not data:
+            return
+        if offset+len(data) > self.size:
+            raise IOError("Write past the end of %s" % self.path)
+        if isinstance(data, memoryview) and not isinstance(self._map, memoryview):
+            # Python 2 mmaps only take strings
+            data = data.tobytes()
+        self._map[offset:offset+len(data)] = data
+        self._lock.acquire()
+        self.ranges.add(offset, offset+len(data))
+        self._lock.release()
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self._offset
+
+    def get_written(self, offset=0):
+        """
+        Returns the number of bytes from ``offset`` on that have been written.
+        """
+        self._lock.acquire()
+        try:
+            return self.ranges.get_length(offset)
+        finally:
+            self._lock.release()
+
+    def get_prefix(self):
+        return self.get_written(0)
+    written = property(get_prefix)
+
+    def view(self, offset, size):
+        """
+        Returns up to ``size`` written bytes from ``offset`` as a slice of the
+        mapping, or ``None`` if the byte at ``offset`` hasn't been written.
+        """
+        size = min(size, self.get_written(offset))
+        if not size:
+            return None
+        return view(self._map, offset, size)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self.fsync != FSYNC_NEVER and self.size:
+            start = time.time()
+            self._map.flush()
+            self.disk_time += time.time()-start
+        os.close(self._fd)
+
+    def is_closed(self):
+        return self._closed
+    closed = property(is_closed)
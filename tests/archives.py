@@ -0,0 +1,115 @@
+"""
+Builds small stored RAR 1.5-4.x and RAR5 archives for the tests.
+"""
+
+import struct
+import zlib
+
+RAR_ID  = 'Rar!\x1a\x07\x00'
+RAR5_ID = 'Rar!\x1a\x07\x01\x00'
+
+MAIN_VOLUME         = 0x0001
+MAIN_NEWNUMBERING   = 0x0010
+MAIN_FIRSTVOLUME    = 0x0100
+FILE_SPLIT_BEFORE   = 0x0001
+FILE_SPLIT_AFTER    = 0x0002
+FILE_DIRECTORY      = 0x00e0
+
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def block(type, flags, body, data=''):
+    header = struct.pack('<BHH', type, flags, 7+len(body)) + body
+    return struct.pack('<H', zlib.crc32(header) & 0xffff) + header + data
+
+def main_header(flags=0):
+    return block(0x73, flags, '\0'*6)
+
+def file_header(name, data, file_size=None, flags=0, crc=None):
+    if file_size is None:
+        file_size = len(data)
+    if crc is None:
+        crc = crc32(data)
+    body = struct.pack('<LLBLLBBHL', len(data), file_size, 2, crc, 0, 29, 0x30, len(name), 0x20) + name
+    return block(0x74, flags | 0x8000, body, data)
+
+def end_header(volume=0, more=False):
+    return block(0x7b, 0x0002 | 0x0008 | (0x0001 if more else 0), struct.pack('<LH', 0, volume))
+
+def archive(members):
+    """
+    Returns a single volume archive of ``members``, ``(name, data)`` or
+    ``(name, data, flags)``.
+    """
+    blocks = []
+    for member in members:
+        name, data, flags = (member+(0,))[:3]
+        blocks.append(file_header(name, data, flags=flags))
+    return RAR_ID + main_header() + ''.join(blocks) + end_header()
+
+def volumes(name, data, count):
+    """
+    Returns ``data`` stored as ``name`` in ``count`` volumes.
+    """
+    size  = (len(data)+count-1)//count
+    parts = [data[i*size:(i+1)*size] for i in range(count)]
+    vols  = []
+    for i, part in enumerate(parts):
+        main  = MAIN_VOLUME | MAIN_NEWNUMBERING | (MAIN_FIRSTVOLUME if i == 0 else 0)
+        flags = (FILE_SPLIT_BEFORE if i > 0 else 0) | (FILE_SPLIT_AFTER if i < count-1 else 0)
+        crc   = crc32(data) if i == count-1 else crc32(part)
+        vols.append(RAR_ID + main_header(main) + file_header(name, part, len(data), flags, crc) +
+                    end_header(i, i < count-1))
+    return vols
+
+def vint(n):
+    out = ''
+    while n > 0x7f:
+        out += chr(n & 0x7f | 0x80)
+        n >>= 7
+    return out + chr(n)
+
+def rar5_block(type, flags, fields, data=None):
+    """
+    Returns a RAR5 block of ``type`` with the type specific ``fields``,
+    followed by ``data`` if it has a data area.
+    """
+    if data is not None:
+        flags |= 0x0002
+    body   = vint(type) + vint(flags) + (vint(len(data)) if data is not None else '') + fields
+    header = vint(len(body)) + body
+    return struct.pack('<L', crc32(header)) + header + (data or '')
+
+def rar5_volumes(name, data, count):
+    """
+    Returns ``data`` stored as ``name`` in ``count`` RAR5 volumes.
+    """
+    size  = (len(data)+count-1)//count
+    parts = [data[i*size:(i+1)*size] for i in range(count)]
+    vols  = []
+    for i, part in enumerate(parts):
+        # Volumes after the first store their number
+        main   = rar5_block(1, 0, vint(0x0001 | (0x0002 if i else 0)) + (vint(i) if i else ''))
+        flags  = (0x0008 if i > 0 else 0) | (0x0010 if i < count-1 else 0)
+        fields = vint(0x0004) + vint(len(data)) + vint(0x20) + struct.pack('<L', crc32(data)) + \
+                 vint(0) + vint(1) + vint(len(name)) + name
+        end    = rar5_block(5, 0, vint(0x0001 if i < count-1 else 0))
+        vols.append(RAR5_ID + main + rar5_block(2, flags, fields, part) + end)
+    return vols
+
+class Segment(object):
+    def __init__(self, number, size):
+        self.number = number
+        self.bytes  = size
+
+class File(object):
+    """
+    Stands in for an ``nzb.NZBFile`` of ``data`` posted in ``part_size``
+    segments.
+    """
+    def __init__(self, filename, data, part_size):
+        self.filename = filename
+        self.subject  = '"%s"' % filename
+        self.size     = len(data)
+        self.chunks   = [data[i:i+part_size] for i in range(0, len(data), part_size)]
+        self.segments = [Segment(i+1, len(chunk)) for i, chunk in enumerate(self.chunks)]
@@ -0,0 +1,32 @@
+import unittest
+
+from nzbstream import httpserver
+
+SIZE = 1000
+
+class ParseRangeTest(unittest.TestCase):
+    def test_range(self):
+        self.assertEqual(httpserver.parse_range('bytes=0-499', SIZE), (0, 499))
+        self.assertEqual(httpserver.parse_range(' bytes=500-999 ', SIZE), (500, 999))
+
+    def test_open_ended(self):
+        self.assertEqual(httpserver.parse_range('bytes=900-', SIZE), (900, 999))
+
+    def test_suffix(self):
+        self.assertEqual(httpserver.parse_range('bytes=-100', SIZE), (900, 999))
+        self.assertEqual(httpserver.parse_range('bytes=-5000', SIZE), (0, 999))
+        self.assertEqual(httpserver.parse_range('bytes=-0', SIZE), None)
+
+    def test_end_past_size(self):
+        self.assertEqual(httpserver.parse_range('bytes=500-5000', SIZE), (500, 999))
+
+    def test_unsatisfiable(self):
+        self.assertEqual(httpserver.parse_range('bytes=1000-', SIZE), None)
+        self.assertEqual(httpserver.parse_range('bytes=500-400', SIZE), None)
+
+    def test_invalid(self):
+        for header in ('bytes=-', 'bytes=0-1,5-6', 'items=0-1', 'bytes=a-b', ''):
+            self.assertEqual(httpserver.parse_range(header, SIZE), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,284 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from nzbstream import rarset, rarspec
+
+import archives
+
+PART_SIZE = 1000
+
+def wants_all(filename):
+    return True
+
+def get_members(srt=True):
+    """
+    Returns ``members``, as for ``rarset.MemberPlan``, of four 10 segment
+    volumes holding movie.mkv, with movie.srt after it in the last volume.
+    """
+    members = [(PART_SIZE, True, [('movie.mkv', 20, 9980, False)]) for i in range(3)]
+    files   = [('movie.mkv', 20, 4000, False)]
+    if srt:
+        files.append(('movie.srt', 4100, 5000, False))
+    members.append((PART_SIZE, True, files))
+    return members
+
+def get_spec():
+    return rarspec.RarSpec("", partial_ok=True, stream=True, parse=False)
+
+class ChunkBufferTest(unittest.TestCase):
+    def test_take_across_chunks(self):
+        buf = rarset.ChunkBuffer()
+        for chunk in ('abc', '', 'defg', 'h'):
+            buf.append(chunk)
+        self.assertEqual(len(buf), 8)
+        self.assertEqual(buf.peek(5), 'abcde')
+        self.assertEqual(len(buf), 8)
+        self.assertEqual([piece.tobytes() for piece in buf.take(5)], ['abc', 'de'])
+        self.assertEqual(buf.peek(10), 'fgh')
+        buf.skip(2)
+        self.assertEqual([piece.tobytes() for piece in buf.take(10)], ['h'])
+        self.assertEqual(len(buf), 0)
+
+class BlockParserTest(unittest.TestCase):
+    NAME = 'movie.mkv'
+    DATA = os.urandom(3000)
+
+    def setUp(self):
+        self.data    = archives.archive([(self.NAME, self.DATA)])
+        marker       = len(archives.RAR_ID)
+        main         = marker + len(archives.main_header())
+        payload      = main + len(archives.file_header(self.NAME, ''))
+        end          = payload + len(self.DATA)
+        # Offsets inside the marker, a base header, a header body and a payload
+        self.splits  = [3, marker+3, marker+10, main+3, main+12, payload+1000, end+3]
+        self.payload = payload
+
+    def parse(self, chunks, parser=None):
+        parser  = parser or rarset.BlockParser(get_spec())
+        types   = []
+        payload = []
+        for chunk in chunks:
+            for event in parser.feed(chunk):
+                if event[0] == rarset.EVENT_HEADER:
+                    types.append(event[1].type)
+                else:
+                    payload.append(event[2].tobytes())
+        return types, ''.join(payload)
+
+    def split(self, splits):
+        bounds = [0] + list(splits) + [len(self.data)]
+        return [self.data[a:b] for a, b in zip(bounds, bounds[1:])]
+
+    def test_whole(self):
+        types, payload = self.parse([self.data])
+        self.assertEqual(types, [rarspec.RAR_BLOCK_MARK, rarspec.RAR_BLOCK_MAIN,
+                                 rarspec.RAR_BLOCK_FILE, rarspec.RAR_BLOCK_ENDARC])
+        self.assertEqual(payload, self.DATA)
+
+    def test_boundaries(self):
+        expected = self.parse([self.data])
+        for split in self.splits:
+            self.assertEqual(self.parse(self.split([split])), expected)
+        self.assertEqual(self.parse(self.split(self.splits)), expected)
+
+    def test_every_byte(self):
+        self.assertEqual(self.parse(self.data), self.parse([self.data]))
+
+    def test_skip(self):
+        parser = rarset.BlockParser(get_spec())
+        types, payload = self.parse([self.data[:self.payload+100]], parser)
+        self.assertEqual(payload, self.DATA[:100])
+
+        parser.skip(len(self.DATA)-100)
+        self.assertEqual(parser.skipped, len(self.DATA)-100)
+        types, payload = self.parse([self.data[self.payload+len(self.DATA):]], parser)
+        self.assertEqual(types, [rarspec.RAR_BLOCK_ENDARC])
+        self.assertEqual(payload, '')
+
+    def test_skip_outside_payload(self):
+        parser = rarset.BlockParser(get_spec())
+        parser.feed(self.data[:self.payload-1])
+        self.assertRaises(rarspec.BadRarFile, parser.skip, 1)
+
+        # Past the end of the payload
+        parser.feed(self.data[self.payload-1:self.payload])
+        self.assertRaises(rarspec.BadRarFile, parser.skip, len(self.DATA)+1)
+
+    def test_rar5(self):
+        data = archives.rar5_volumes(self.NAME, self.DATA, 1)[0]
+        expected = self.parse([data])
+        self.assertEqual(expected, ([rarspec.RAR_BLOCK_MARK, rarspec.RAR_BLOCK_MAIN,
+                                     rarspec.RAR_BLOCK_FILE, rarspec.RAR_BLOCK_ENDARC], self.DATA))
+        self.assertEqual(self.parse(data), expected)
+
+class RarVolumeTest(unittest.TestCase):
+    def get_volumes(self, vols):
+        files = [archives.File('movie.part%d.rar' % (i+1), data, PART_SIZE) for i, data in enumerate(vols)]
+        return [rarset.RarVolume(f, f.chunks[0], f.chunks[-1]) for f in files]
+
+    def test_rar4(self):
+        volumes = self.get_volumes(archives.volumes('movie.mkv', 'x'*9000, 3))
+        self.assertEqual([v.first_volume for v in volumes], [True, False, False])
+        self.assertEqual([v.volume_number for v in volumes], [0, 1, 2])
+        offset = len(archives.RAR_ID + archives.main_header() + archives.file_header('movie.mkv', ''))
+        self.assertEqual(volumes[0].get_payload(), (offset, 3000, 'movie.mkv'))
+
+    def test_rar5(self):
+        volumes = self.get_volumes(archives.rar5_volumes('movie.mkv', 'x'*9000, 3))
+        self.assertTrue(all(v.is_rar and v.rar5 and v.complete for v in volumes))
+        self.assertEqual([v.first_volume for v in volumes], [True, False, False])
+        # Read from the main header, not the end of archive block
+        self.assertEqual([v.volume_number for v in volumes], [0, 1, 2])
+        self.assertEqual([v.get_members()[0][::2] for v in volumes], [('movie.mkv', 3000)]*3)
+
+    def test_not_rar(self):
+        volume = self.get_volumes(['Not a rarchive'])[0]
+        self.assertFalse(volume.is_rar)
+        self.assertEqual(volume.get_members(), [])
+
+class GroupRarsetsTest(unittest.TestCase):
+    def get_files(self, names):
+        return [archives.File(name, 'x', PART_SIZE) for name in names]
+
+    def test_by_name(self):
+        nzb = self.get_files(['show.s01e02.part1.rar', 'show.s01e01.rar', 'show.s01e01.r00',
+                              'show.s01e02.part2.rar', 'show.s01e01.nfo'])
+        rarsets = rarset.group_rarsets(nzb)
+        self.assertEqual([(name, [f.filename for f in files]) for name, files, members in rarsets],
+                         [('show.s01e01', ['show.s01e01.rar', 'show.s01e01.r00']),
+                          ('show.s01e02', ['show.s01e02.part1.rar', 'show.s01e02.part2.rar'])])
+
+    def test_by_headers(self):
+        # Obfuscated names; the split members tell the rarsets apart
+        vols  = archives.volumes('a.mkv', 'a'*6000, 2) + archives.volumes('b.mkv', 'b'*6000, 2)
+        names = ['1f3a.rar', '77c0.rar', '9e21.rar', 'c4d8.rar']
+        nzb   = [archives.File(name, data, PART_SIZE) for name, data in zip(names, vols)]
+        volumes = [rarset.RarVolume(f, f.chunks[0], f.chunks[-1]) for f in nzb]
+        rarsets = rarset.group_rarsets(nzb, volumes)
+        self.assertEqual([(name, [f.filename for f in files], members) for name, files, members in rarsets],
+                         [('a', names[:2], ['a.mkv']), ('b', names[2:], ['b.mkv'])])
+
+class SeekIndexTest(unittest.TestCase):
+    def setUp(self):
+        # Two volumes of 10 segments, the payload starting 60 bytes in
+        self.index = rarset.SeekIndex()
+        self.index.add_volume(60, 9900, PART_SIZE, 0)
+        self.index.add_volume(60, 5000, PART_SIZE, 10)
+
+    def test_locate(self):
+        self.assertEqual(self.index.size, 14900)
+        self.assertEqual(self.index.locate(0), (0, 0, 60))
+        self.assertEqual(self.index.locate(940), (0, 1, 0))
+        self.assertEqual(self.index.locate(9899), (0, 9, 959))
+        self.assertEqual(self.index.locate(9900), (1, 10, 60))
+        self.assertRaises(IndexError, self.index.locate, 14900)
+        self.assertRaises(IndexError, self.index.locate, -1)
+
+    def test_span(self):
+        self.assertEqual(self.index.span(0), (0, 0, 60, 940))
+        self.assertEqual(self.index.span(14000), (1, 14, 160, 840))
+        # Up to the end of the file, not of the segment
+        self.assertEqual(self.index.span(14850), (1, 15, 10, 50))
+
+    def test_layout(self):
+        plan = rarset.LayoutPlan(self.index, [10, 7])
+        self.assertEqual(len(plan), 17)
+        self.assertEqual(plan.get(0), (60, PART_SIZE, 0))
+        self.assertEqual(plan.get(1), (0, PART_SIZE, 940))
+        self.assertEqual(plan.get(9), (0, 960, 8940))
+        self.assertEqual(plan.get(10), (60, PART_SIZE, 9900))
+        self.assertEqual(plan.get(14), (0, PART_SIZE, 13840))
+        self.assertEqual(plan.get(15), (0, 60, 14840))
+        # Only headers after the payload
+        start, end, dest = plan.get(16)
+        self.assertEqual(start, end)
+
+class SingleMemberTest(unittest.TestCase):
+    def test_single(self):
+        self.assertEqual(rarset.get_single_member(get_members(srt=False), wants_all), 'movie.mkv')
+
+    def test_second_member(self):
+        self.assertEqual(rarset.get_single_member(get_members(), wants_all), None)
+
+    def test_unwanted(self):
+        wants = lambda filename: not filename.endswith('.mkv')
+        self.assertEqual(rarset.get_single_member(get_members(srt=False), wants), None)
+
+    def test_incomplete(self):
+        members = get_members(srt=False)
+        members[-1] = (PART_SIZE, False, members[-1][2])
+        self.assertEqual(rarset.get_single_member(members, wants_all), None)
+
+    def test_unread(self):
+        members = get_members(srt=False)
+        members[1] = None
+        self.assertEqual(rarset.get_single_member(members, wants_all), None)
+
+class MemberPlanTest(unittest.TestCase):
+    def test_main_member_excluded(self):
+        wants   = lambda filename: not filename.endswith('.mkv')
+        members = get_members()
+        self.assertEqual(rarset.get_single_member(members, wants), None)
+
+        plan = rarset.MemberPlan(members, [10]*4, wants)
+        # The first three volumes hold nothing else
+        self.assertEqual(plan.dropped, set(range(30)) | set([31, 32, 33]))
+        # The srt starts in the fifth segment of the last volume
+        self.assertEqual(plan.skips, {34: 3*PART_SIZE})
+
+    def test_extra_member_excluded(self):
+        wants   = lambda filename: not filename.endswith('.srt')
+        members = get_members()
+        self.assertEqual(rarset.get_single_member(members, wants), None)
+
+        plan = rarset.MemberPlan(members, [10]*4, wants)
+        self.assertEqual(plan.dropped, set([35, 36, 37, 38]))
+        self.assertEqual(plan.skips, {39: 4*PART_SIZE})
+
+class RarSetTest(unittest.TestCase):
+    def setUp(self):
+        # Extracted files go to the working directory
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def extract(self, data, chunk_size=777, **kwargs):
+        rs = rarset.RarSet([], rarchives=[archives.File('test.rar', data, 3000)], **kwargs)
+        for i in range(0, len(data), chunk_size):
+            rs.read(data[i:i+chunk_size])
+        for rarfile in rs.files.values():
+            rarfile.close()
+        return rs
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_directories(self):
+        movie = os.urandom(50000)
+        srt   = os.urandom(3000)
+        rs = self.extract(archives.archive([('movie.mkv', movie), ('Subs', '', archives.FILE_DIRECTORY),
+                                            ('Subs\\eng.srt', srt), ('empty.txt', '')]))
+        self.assertEqual(list(rs.files), ['movie.mkv', 'Subs\\eng.srt', 'empty.txt'])
+        self.assertTrue(rs.is_complete())
+        self.assertEqual([progress for name, progress in rs.get_progress()], [1.0]*3)
+        self.assertEqual(self.read('movie.mkv'), movie)
+        self.assertEqual(self.read(os.path.join('Subs', 'eng.srt')), srt)
+        self.assertEqual(self.read('empty.txt'), '')
+
+    def test_main_file(self):
+        nfo   = 'Release notes\r\n'
+        movie = os.urandom(20000)
+        rs = self.extract(archives.archive([('movie.nfo', nfo), ('movie.mkv', movie)]))
+        self.assertEqual(rs.main_file, rs.files['movie.mkv'])
+        self.assertEqual(self.read('movie.nfo'), nfo)
+        self.assertEqual(self.read('movie.mkv'), movie)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from nzbstream import scheduler
+
+BITRATE = 1000000
+
+class FakeScheduler(object):
+    bitrate = BITRATE
+
+class BufferThrottleTest(unittest.TestCase):
+    def get_rate(self, target, buffered):
+        throttle = scheduler.BufferThrottle(None, FakeScheduler(), target)
+        return throttle.get_rate(buffered)
+
+    def test_low_buffer(self):
+        self.assertEqual(self.get_rate(60, 10), 0)
+
+    def test_half_full(self):
+        self.assertEqual(self.get_rate(60, 30), BITRATE*scheduler.MAX_RATE_MULT)
+
+    def test_full(self):
+        self.assertEqual(self.get_rate(60, 90), BITRATE*scheduler.MIN_RATE_MULT)
+
+    def test_zero_target(self):
+        self.assertEqual(self.get_rate(0, 0), 0)
+        self.assertEqual(self.get_rate(0, 10), 0)
+
+if __name__ == '__main__':
+    unittest.main()